@@ -0,0 +1,175 @@
+"""
+Builds the gazetteer db used by geocode.OptimizedCoder from raw gazetteer dumps.
+
+Usage:
+    python -m automap.gazetteer resources/gazetteers.db --geonames allCountries.txt --gns Countries.txt --prepped osm=osm.db natearth=natearth.db
+
+The db has one row per location in the locs table, with plain lon/lat columns,
+and one row per location name in the names table, along with a normalized version
+of the name used for lookups. Both tables are indexed so that name lookups
+can be answered from the indexes alone, and location coordinates are indexed
+in an R*Tree so that lookups can be limited to a bbox.
+
+An R*Tree can also be added to an existing gazetteer db, including older ones with wkb geometries:
+    python -m automap.gazetteer resources/gazetteers.db --add-spatial-index
+"""
+
+import os
+import io
+import sqlite3
+import itertools
+
+from .geocode import normalize_name, wkb_to_shapely
+
+
+SCHEMA = '''
+CREATE TABLE locs (data TEXT, id INTEGER, lon REAL, lat REAL, fclass TEXT, population INTEGER);
+CREATE TABLE names (data TEXT, id INTEGER, name TEXT, name_norm TEXT);
+CREATE UNIQUE INDEX locs_data_id ON locs (data, id);
+'''
+
+INDEXES = '''
+CREATE INDEX names_norm ON names (name_norm, data, id);
+CREATE INDEX names_data_id ON names (data, id, name);
+'''
+
+SPATIAL_INDEX = '''
+CREATE VIRTUAL TABLE locs_rtree USING rtree(id, minlon, maxlon, minlat, maxlat);
+'''
+
+
+def read_geonames(path):
+    '''Reads a GeoNames dump (eg allCountries.txt), yielding (id, lon, lat, fclass, population, names) for each location'''
+    with io.open(path, encoding='utf8') as fobj:
+        for line in fobj:
+            row = line.rstrip('\n').split('\t')
+            if len(row) < 15:
+                continue
+            ID,name,asciiname,altnames,lat,lon,fclass = row[:7]
+            population = int(row[14]) if row[14] else None
+            names = [name, asciiname] + altnames.split(',')
+            yield int(ID), float(lon), float(lat), fclass, population, names
+
+def read_gns(path):
+    '''Reads a GNS (GEOnet Names Server) dump, yielding (id, lon, lat, fclass, population, names) for each name row.
+    The same location appears once for each of its names.'''
+    with io.open(path, encoding='utf8') as fobj:
+        fields = next(fobj).rstrip('\n').split('\t')
+        for line in fobj:
+            row = dict(zip(fields, line.rstrip('\n').split('\t')))
+            lat = row.get('LAT') or row.get('LAT_DD')
+            lon = row.get('LONG') or row.get('LONG_DD')
+            if not lat or not lon:
+                continue
+            names = [row.get('FULL_NAME_RO'), row.get('FULL_NAME_ND_RO')]
+            yield int(row['UFI']), float(lon), float(lat), row.get('FC'), None, names
+
+def read_prepped(path, table='data'):
+    '''Reads a prepped gazetteer db as used by geocode.SQLiteCoder, with '|' separated names and lon/lat columns,
+    yielding (id, lon, lat, fclass, population, names) for each location'''
+    db = sqlite3.connect(path)
+    for ID,names,lon,lat in db.execute('SELECT rowid, names, lon, lat FROM {}'.format(table)):
+        yield ID, lon, lat, None, None, (names or '').split('|')
+
+
+def build_gazetteer(path, sources, batchsize=100000):
+    '''Builds a new gazetteer db at path.
+    - sources is a list of (data, rows) tuples, where data is the name of the gazetteer source
+    and rows is an iterable of (id, lon, lat, fclass, population, names), eg from the read_* functions.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.executescript(SCHEMA)
+
+    for data,rows in sources:
+        print('loading', data)
+        count = 0
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batchsize))
+            if not batch:
+                break
+            locs = []
+            names = []
+            for ID,lon,lat,fclass,population,locnames in batch:
+                locs.append((data, ID, lon, lat, fclass, population))
+                seen = set()
+                for name in locnames:
+                    name = name.strip() if name else None
+                    if name and name not in seen:
+                        seen.add(name)
+                        names.append((data, ID, name, normalize_name(name)))
+            # same location can be listed more than once, eg for each name in gns
+            db.executemany('INSERT OR IGNORE INTO locs VALUES (?,?,?,?,?,?)', locs)
+            db.executemany('INSERT INTO names VALUES (?,?,?,?)', names)
+            db.commit()
+            count += len(batch)
+            print(count, 'rows')
+
+    # drop duplicate names
+    print('removing duplicates')
+    db.execute('DELETE FROM names WHERE rowid NOT IN (SELECT MIN(rowid) FROM names GROUP BY data, id, name)')
+    db.commit()
+
+    # index and collect query planner stats
+    print('indexing')
+    db.executescript(INDEXES)
+    add_spatial_index(db)
+    db.execute('ANALYZE')
+    db.commit()
+    db.close()
+
+def add_spatial_index(db, batchsize=100000):
+    '''Adds an R*Tree index of the bounds of each location in the locs table of an open gazetteer db connection,
+    with the locs rowid as id, replacing any existing one.'''
+    print('spatial indexing')
+    db.execute('DROP TABLE IF EXISTS locs_rtree')
+    db.executescript(SPATIAL_INDEX)
+    columns = [row[1] for row in db.execute('PRAGMA table_info(locs)')]
+    if 'lon' in columns:
+        db.execute('INSERT INTO locs_rtree SELECT rowid, lon, lon, lat, lat FROM locs WHERE lon IS NOT NULL AND lat IS NOT NULL')
+    else:
+        # older dbs with wkb geometries
+        rows = db.execute('SELECT rowid, geom FROM locs WHERE geom IS NOT NULL')
+        while True:
+            batch = rows.fetchmany(batchsize)
+            if not batch:
+                break
+            bounds = []
+            for rowid,geom in batch:
+                xmin,ymin,xmax,ymax = wkb_to_shapely(geom).bounds
+                bounds.append((rowid, xmin, xmax, ymin, ymax))
+            db.executemany('INSERT INTO locs_rtree VALUES (?,?,?,?,?)', bounds)
+    db.commit()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Builds the gazetteer db used for geocoding map toponyms.')
+    parser.add_argument('path', help='output gazetteer db')
+    parser.add_argument('--add-spatial-index', action='store_true',
+                        help='only add a spatial index to the existing gazetteer db at path')
+    parser.add_argument('--geonames', help='GeoNames dump, eg allCountries.txt')
+    parser.add_argument('--gns', help='GNS dump')
+    parser.add_argument('--prepped', nargs='*', default=[], metavar='DATA=PATH',
+                        help='prepped gazetteer dbs with a data table of names, lon, lat, eg osm=osm.db')
+    args = parser.parse_args()
+
+    if args.add_spatial_index:
+        db = sqlite3.connect(args.path)
+        add_spatial_index(db)
+        db.close()
+        raise SystemExit
+
+    sources = []
+    if args.geonames:
+        sources.append(('geonames', read_geonames(args.geonames)))
+    if args.gns:
+        sources.append(('gns', read_gns(args.gns)))
+    for prepped in args.prepped:
+        data,prepped_path = prepped.split('=', 1)
+        sources.append((data, read_prepped(prepped_path)))
+    build_gazetteer(args.path, sources)
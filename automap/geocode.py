@@ -1,6 +1,14 @@
 
+import os
 import sqlite3
-import shapely, shapely.wkb
+import hashlib
+import struct
+import unicodedata
+import pickle
+from collections import OrderedDict
+import shapely, shapely.wkb, shapely.geometry
+
+import numpy as np
 
 
 ##class Matches(object):
@@ -52,26 +60,650 @@ def wkb_to_shapely(wkbbuf):
     shp = shapely.wkb.loads(bytes(wkbbuf))
     return shp
 
+# feature classes ranked first when limiting geocode results, populated places then administrative areas
+FCLASS_RANKS = {'P': 0, 'A': 1}
+
+def rank_candidates(cands, fclass=None, population=None, agree_dist=0.5):
+    '''Returns the indexes of Candidates ordered from most to least likely, ranked first by the number of
+    other gazetteer sources with a location within agree_dist degrees, then by feature class, then by population.
+    fclass and population are optional lists for each location, where None values rank last.'''
+    n = len(cands)
+    agree = np.zeros(n, dtype=np.int32)
+    for src in range(len(cands.sources)):
+        others = cands.data == src
+        if not others.any():
+            continue
+        lon,lat = cands.lon[others],cands.lat[others]
+        for i in range(0, n, 1000):
+            near = np.hypot(cands.lon[i:i+1000,None]-lon, cands.lat[i:i+1000,None]-lat) < agree_dist
+            agree[i:i+1000] += near.any(axis=1) & (cands.data[i:i+1000] != src)
+    fclass_rank = np.array([FCLASS_RANKS.get(fc, len(FCLASS_RANKS)) for fc in (fclass or [None]*n)])
+    population = np.array([pop or 0 for pop in (population or [None]*n)], dtype=np.int64)
+    return np.lexsort((np.arange(n), -population, fclass_rank, -agree))
+
+
+def normalize_name(name):
+    '''Returns the lowercase, accent stripped and whitespace collapsed version of a name, used for name lookups'''
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join((ch for ch in name if not unicodedata.combining(ch)))
+    return ' '.join(name.lower().split())
+
+def _hash(s):
+    digest = hashlib.blake2b(s.encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+def name_hash(name):
+    '''Returns a stable 64-bit hash of the normalized name'''
+    return _hash(normalize_name(name))
+
+
+class NameIndex(object):
+    def __init__(self, table):
+        '''Index of normalized name hashes and the rowid of each matching location in the gazetteer locs table,
+        stored as a numpy array sorted by hash so that many names can be looked up at once with a binary search.'''
+        self.table = table
+
+    @classmethod
+    def build(cls, db, batchsize=100000):
+        '''Builds the index from all names in an open gazetteer db connection, in batches of rows.
+        Dbs built with gazetteer.build_gazetteer() already store the normalized names, which are used as is.'''
+        print('building gazetteer name index')
+        columns = [row[1] for row in db.execute('PRAGMA table_info(names)')]
+        if 'name_norm' in columns:
+            rows = db.cursor().execute('SELECT names.name_norm, locs.rowid FROM names JOIN locs ON locs.data = names.data AND locs.id = names.id')
+            hashfunc = _hash
+        else:
+            rows = db.cursor().execute('SELECT names.name, locs.rowid FROM names JOIN locs ON locs.data = names.data AND locs.id = names.id')
+            hashfunc = name_hash
+        parts = []
+        while True:
+            batch = rows.fetchmany(batchsize)
+            if not batch:
+                break
+            batch = [(name,rowid) for name,rowid in batch if name]
+            part = np.empty(len(batch), dtype=[('hash','<u8'), ('rowid','<i8')])
+            part['hash'] = [hashfunc(name) for name,rowid in batch]
+            part['rowid'] = [rowid for name,rowid in batch]
+            parts.append(part)
+        table = np.concatenate(parts) if parts else np.empty(0, dtype=[('hash','<u8'), ('rowid','<i8')])
+        table.sort(order=['hash','rowid'])
+        return cls(table)
+
+    @classmethod
+    def load(cls, path):
+        '''Loads an index saved with save(), memory-mapped so that it's shared between processes and loads instantly'''
+        return cls(np.load(path, mmap_mode='r'))
+
+    def save(self, path):
+        np.save(path, self.table)
+
+    def lookup(self, names):
+        '''Returns a list with the array of matching locs rowids for each name'''
+        hashes = np.array([name_hash(name) for name in names], dtype=np.uint64)
+        keys = self.table['hash']
+        starts = np.searchsorted(keys, hashes, side='left')
+        ends = np.searchsorted(keys, hashes, side='right')
+        rowids = self.table['rowid']
+        return [np.unique(rowids[start:end]) for start,end in zip(starts,ends)]
+
+_name_indexes = dict()
+
+def get_name_index(path):
+    '''Returns the name index for the gazetteer db at path, loaded only once per process.
+    The index is stored next to the db and rebuilt if the db has changed since.'''
+    path = os.path.abspath(path)
+    if path not in _name_indexes:
+        indexpath = path + '.names.npy'
+        if os.path.exists(indexpath) and os.path.getmtime(indexpath) >= os.path.getmtime(path):
+            index = NameIndex.load(indexpath)
+        else:
+            index = NameIndex.build(sqlite3.connect(path))
+            try:
+                index.save(indexpath)
+            except (IOError, OSError) as err:
+                print('could not save gazetteer name index:', err)
+        _name_indexes[path] = index
+    return _name_indexes[path]
+
+
+def edit_distance(a, b):
+    '''Returns the levenshtein edit distance between two strings'''
+    if len(a) < len(b):
+        a,b = b,a
+    prev = list(range(len(b)+1))
+    for i,ca in enumerate(a):
+        cur = [i+1]
+        for j,cb in enumerate(b):
+            cur.append(min(prev[j+1]+1, cur[j]+1, prev[j]+(ca != cb)))
+        prev = cur
+    return prev[-1]
+
+def name_deletes(name, max_distance):
+    '''Returns the set of the name and all variants of it with up to max_distance characters deleted'''
+    deletes = set([name])
+    edge = set([name])
+    for _ in range(max_distance):
+        edge = set((n[:i]+n[i+1:] for n in edge for i in range(len(n))))
+        deletes.update(edge)
+    return deletes
+
+def _hashes(strings):
+    return np.array([_hash(s) for s in strings], dtype=np.uint64)
+
+
+class FuzzyIndex(object):
+    def __init__(self, names, offsets, hashes, nameids, max_distance):
+        '''Symmetric delete index of normalized gazetteer names, for finding names within a small edit distance
+        without comparing against all names: two names are within the edit distance only if they share a
+        variant with up to max_distance characters deleted.
+        - names is a utf8 encoded uint8 buffer of all distinct normalized names, and offsets the start of each name.
+        - hashes are the sorted hashes of all delete variants, and nameids the name number of each, kept as
+        separate contiguous arrays so they can be binary searched directly from a memory-mapped file.
+        '''
+        self.names = names
+        self.offsets = offsets
+        self.hashes = hashes
+        self.nameids = nameids
+        self.max_distance = max_distance
+
+    @classmethod
+    def build(cls, db, max_distance=1):
+        '''Builds the index from all names in an open gazetteer db connection'''
+        print('building gazetteer fuzzy name index')
+        names = sorted(set((normalize_name(name) for name, in db.cursor().execute('SELECT DISTINCT name FROM names') if name)))
+        encoded = [name.encode('utf8') for name in names]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(name) for name in encoded])
+        buf = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        # hash all delete variants of each name
+        parts = []
+        for i in range(0, len(names), 100000):
+            chunk = [(variant,nameid) for nameid,name in enumerate(names[i:i+100000], i)
+                     for variant in name_deletes(name, max_distance)]
+            variants,nameids = zip(*chunk) if chunk else ([],[])
+            part = np.empty(len(chunk), dtype=[('hash','<u8'), ('name','<i4')])
+            part['hash'] = _hashes(variants)
+            part['name'] = nameids
+            parts.append(part)
+        deletes = np.concatenate(parts) if parts else np.empty(0, dtype=[('hash','<u8'), ('name','<i4')])
+        deletes.sort(order=['hash','name'])
+        return cls(buf, offsets, deletes['hash'].copy(), deletes['name'].copy(), max_distance)
+
+    @classmethod
+    def load(cls, prefix, max_distance):
+        '''Loads an index saved with save(), memory-mapped'''
+        return cls(np.load(prefix + '.names.npy', mmap_mode='r'),
+                   np.load(prefix + '.offsets.npy', mmap_mode='r'),
+                   np.load(prefix + '.hashes.npy', mmap_mode='r'),
+                   np.load(prefix + '.nameids.npy', mmap_mode='r'),
+                   max_distance)
+
+    def save(self, prefix):
+        np.save(prefix + '.names.npy', self.names)
+        np.save(prefix + '.offsets.npy', self.offsets)
+        np.save(prefix + '.hashes.npy', self.hashes)
+        np.save(prefix + '.nameids.npy', self.nameids)
+
+    def name(self, nameid):
+        start,end = self.offsets[nameid],self.offsets[nameid+1]
+        return self.names[start:end].tobytes().decode('utf8')
+
+    def lookup(self, name, max_distance=None):
+        '''Returns a list of (name, distance) of all normalized names within max_distance edits of name,
+        sorted by distance'''
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        query = normalize_name(name)
+        hashes = _hashes(name_deletes(query, max_distance))
+        starts = np.searchsorted(self.hashes, hashes, side='left')
+        ends = np.searchsorted(self.hashes, hashes, side='right')
+        nameids = set()
+        for start,end in zip(starts.tolist(),ends.tolist()):
+            if end > start:
+                nameids.update(self.nameids[start:end].tolist())
+
+        # verify actual distance
+        matches = []
+        for nameid in nameids:
+            candidate = self.name(nameid)
+            dist = edit_distance(query, candidate)
+            if dist <= max_distance:
+                matches.append((candidate, dist))
+        return sorted(matches, key=lambda m: (m[1], m[0]))
+
+_fuzzy_indexes = dict()
+
+def get_fuzzy_index(path, max_distance=1):
+    '''Returns the fuzzy name index for the gazetteer db at path, loaded only once per process.
+    The index is stored next to the db and rebuilt if the db has changed since.'''
+    path = os.path.abspath(path)
+    key = (path, max_distance)
+    if key not in _fuzzy_indexes:
+        prefix = '{}.fuzzy{}'.format(path, max_distance)
+        if os.path.exists(prefix + '.nameids.npy') and os.path.getmtime(prefix + '.nameids.npy') >= os.path.getmtime(path):
+            index = FuzzyIndex.load(prefix, max_distance)
+        else:
+            index = FuzzyIndex.build(sqlite3.connect(path), max_distance)
+            try:
+                index.save(prefix)
+            except (IOError, OSError) as err:
+                print('could not save gazetteer fuzzy index:', err)
+        _fuzzy_indexes[key] = index
+    return _fuzzy_indexes[key]
+
+
+def wkb_point(wkbbuf):
+    '''Returns the lon/lat of a wkb geometry, read directly from the wkb bytes for points,
+    otherwise the centroid of the decoded geometry'''
+    wkbbuf = bytes(wkbbuf)
+    order = '<' if wkbbuf[0] == 1 else '>'
+    geomtype, = struct.unpack(order+'I', wkbbuf[1:5])
+    if geomtype == 1:
+        return struct.unpack(order+'dd', wkbbuf[5:21])
+    centroid = wkb_to_shapely(wkbbuf).centroid
+    return centroid.x, centroid.y
+
+
+class Candidates(object):
+    def __init__(self, search, lon, lat, data, ids, names, sources, geoms=None, distance=None):
+        '''Compact version of the list of geocode results for a name, as numpy arrays of the lon, lat,
+        source (as indexes into the sources list), id, and '|' separated names of each location.
+        - geoms is an optional array of the full location geometries, as wkb or geojson, which are only
+        decoded when requested with geometry().
+        - distance is an optional array of the edit distance of each location name, for fuzzy results.
+        Indexing with an integer or iterating returns point features in the same format as geocode(),
+        and indexing with a boolean mask or list of indexes returns a new Candidates with the selected locations.'''
+        self.search = search
+        self.lon = lon
+        self.lat = lat
+        self.data = data
+        self.ids = ids
+        self.names = names
+        self.sources = sources
+        self.geoms = geoms
+        self.distance = distance
+
+    @classmethod
+    def from_rows(cls, search, rows, plain_coords=True):
+        '''Creates from gazetteer db rows of (data, id, names, lon, lat), or (data, id, names, wkb) if not plain_coords'''
+        rows = list(rows)
+        n = len(rows)
+        lon,lat = np.empty(n),np.empty(n)
+        data = np.empty(n, dtype=np.int16)
+        ids = np.empty(n, dtype=np.int64)
+        names = np.empty(n, dtype=object)
+        geoms = None if plain_coords else np.empty(n, dtype=object)
+        sources = []
+        sourceindex = dict()
+        for i,row in enumerate(rows):
+            source,ids[i],names[i] = row[:3]
+            if source not in sourceindex:
+                sourceindex[source] = len(sources)
+                sources.append(source)
+            data[i] = sourceindex[source]
+            if plain_coords:
+                lon[i],lat[i] = row[3:5]
+            else:
+                geoms[i] = row[3]
+                lon[i],lat[i] = wkb_point(row[3])
+        return cls(search, lon, lat, data, ids, names, sources, geoms)
+
+    @classmethod
+    def from_features(cls, search, features):
+        '''Creates from a list of geocode result features, eg from coders without compact results.
+        Locations without an id get an id of -1.'''
+        rows = []
+        geoms = []
+        for f in features:
+            props = f['properties']
+            geoms.append(f['geometry'])
+            x,y = shapely.geometry.shape(f['geometry']).centroid.coords[0]
+            ID = props.get('id')
+            rows.append((props.get('data'), -1 if ID is None else ID, props.get('name'), x, y))
+        cands = cls.from_rows(search, rows)
+        cands.geoms = np.empty(len(geoms), dtype=object)
+        cands.geoms[:] = geoms
+        return cands
+
+    @classmethod
+    def concat(cls, search, parts):
+        '''Combines a list of Candidates into one, eg the fuzzy results of several names'''
+        if not parts:
+            return cls.from_rows(search, [])
+        sources = []
+        for part in parts:
+            sources.extend((src for src in part.sources if src not in sources))
+        # renumber the sources of each part
+        data = np.concatenate([np.array([sources.index(src) for src in part.sources], dtype=np.int16)[part.data]
+                               for part in parts])
+        def combine(attr):
+            arrays = [getattr(part, attr) for part in parts]
+            if any((arr is None for arr in arrays)):
+                return None
+            return np.concatenate(arrays)
+        return cls(search, combine('lon'), combine('lat'), data, combine('ids'), combine('names'),
+                   sources, combine('geoms'), combine('distance'))
+
+    def __len__(self):
+        return len(self.lon)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int,np.integer)):
+            props = {'data': self.sources[self.data[key]],
+                     'id': self.ids[key].item(),
+                     'name': self.names[key],
+                     'search': self.search,
+                     }
+            if self.distance is not None:
+                props['distance'] = self.distance[key].item()
+            return {'type': 'Feature',
+                    'properties': props,
+                    'geometry': {'type': 'Point', 'coordinates': (self.lon[key].item(), self.lat[key].item())},
+                    }
+        else:
+            return self.subset(key)
+
+    def subset(self, key):
+        '''Returns a new Candidates with only the locations selected by a boolean mask or list of indexes'''
+        key = np.asarray(key)
+        if key.dtype != bool:
+            key = key.astype(np.intp)
+        select = lambda arr: arr[key] if arr is not None else None
+        return Candidates(self.search, self.lon[key], self.lat[key], self.data[key], self.ids[key], self.names[key],
+                          list(self.sources), select(self.geoms), select(self.distance))
+
+    def copy(self):
+        return self.subset(np.ones(len(self), dtype=bool))
+
+    def geometry(self, i):
+        '''Returns the full geojson geometry of a location, decoding it only now'''
+        if self.geoms is None:
+            return {'type': 'Point', 'coordinates': (self.lon[i].item(), self.lat[i].item())}
+        geom = self.geoms[i]
+        if isinstance(geom, dict):
+            return geom
+        return wkb_to_shapely(geom).__geo_interface__
+
+    @property
+    def coords(self):
+        '''List of lon,lat tuples'''
+        return list(zip(self.lon.tolist(), self.lat.tolist()))
+
+    def source_mask(self, source):
+        '''Returns a boolean mask of locations from the given gazetteer source'''
+        if source not in self.sources:
+            return np.zeros(len(self), dtype=bool)
+        return self.data == self.sources.index(source)
+
+    def bbox_mask(self, bbox):
+        '''Returns a boolean mask of locations within bbox [xmin,ymin,xmax,ymax]'''
+        xmin,ymin,xmax,ymax = bbox
+        return (self.lon >= xmin) & (self.lon <= xmax) & (self.lat >= ymin) & (self.lat <= ymax)
+
+    def to_features(self):
+        return list(self)
+
 
 class OptimizedCoder(object):
-    def __init__(self, path=None):
+    def __init__(self, path=None, name_index=False, max_distance=0):
+        '''If name_index is True, geocode_many() looks up names in an in-memory index of
+        normalized names, see get_name_index().
+        If max_distance is set, names can also be looked up with up to max_distance character edits
+        using a fuzzy name index, see get_fuzzy_index().
+        All geocode methods take an optional bbox [xmin,ymin,xmax,ymax] to only return locations in that region,
+        which is done with the locs_rtree spatial index if the db has one, see gazetteer.add_spatial_index().'''
         self.path = path or 'resources/gazetteers.db'
         self.db = sqlite3.connect(self.path)
+        self.name_index = get_name_index(self.path) if name_index else None
+        self.fuzzy_index = get_fuzzy_index(self.path, max_distance) if max_distance else None
+
+        # dbs built with gazetteer.build_gazetteer() have plain lon/lat columns and normalized names,
+        # older ones wkb geometries
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(locs)')]
+        self.plain_coords = 'lon' in columns
+        self.geom_fields = 'locs.lon, locs.lat' if self.plain_coords else 'locs.geom'
+        self.spatial_index = self.db.execute("SELECT name FROM sqlite_master WHERE name = 'locs_rtree'").fetchone() is not None
+        self.rank_fields = ', locs.fclass, locs.population' if 'fclass' in columns else ''
+
+    def _feature(self, name, data, ID, names, *geom):
+        if self.plain_coords:
+            geoj = {'type': 'Point', 'coordinates': geom}
+        else:
+            geoj = wkb_to_shapely(geom[0]).__geo_interface__
+        return {'type': 'Feature',
+               'properties': {'data':data,
+                              'id':ID,
+                              'name':names,
+                              'search':name,
+                              },
+               'geometry': geoj,
+               }
 
-    def geocode(self, name, limit=None):
-        # NOT CORRRECT QUERY, RETURNS DUPLICATES
+    def _bbox_filter(self, bbox):
+        '''Returns the sql condition and params for limiting locs to bbox using the spatial index.
+        The r*tree is probed by rowid for each location matching the name, rather than collecting
+        all locations in the bbox first, which would be slow for large bboxes.'''
+        xmin,ymin,xmax,ymax = bbox
+        cond = 'EXISTS (SELECT 1 FROM locs_rtree AS r WHERE r.id = locs.rowid AND r.maxlon >= ? AND r.minlon <= ? AND r.maxlat >= ? AND r.minlat <= ?)'
+        return cond, (xmin, xmax, ymin, ymax)
+
+    def _results(self, name, rows, bbox=None, compact=False, limit=None):
+        '''Returns the geocode results of name from its gazetteer db rows, as Candidates if compact,
+        otherwise as a list of features. If limit is given, only the limit highest ranked results are
+        returned, see rank_candidates().'''
+        rows = [tuple(row) for row in rows]
+        fclass = population = None
+        if self.rank_fields:
+            fclass = [row[-2] for row in rows]
+            population = [row[-1] for row in rows]
+            rows = [row[:-2] for row in rows]
+        cands = Candidates.from_rows(name, rows, self.plain_coords)
+        keep = np.arange(len(rows))
+        if bbox and not self.spatial_index:
+            keep = keep[cands.bbox_mask(bbox)]
         if limit:
-            raise NotImplemented("Geocode results 'limit' not yet implemented")
-        results = self.db.cursor().execute("SELECT locs.data, locs.id, GROUP_CONCAT(names.name, '|'), locs.geom FROM locs, names, (SELECT data,id FROM names WHERE name = ? COLLATE NOCASE) AS m WHERE locs.id=m.id AND locs.data=m.data and names.id=m.id and names.data=m.data GROUP BY m.data,m.id", (name,))
-        results = ({'type': 'Feature',
-                   'properties': {'data':data,
-                                  'id':ID,
-                                  'name':names,
-                                  'search':name,
-                                  },
-                   'geometry': wkb_to_shapely(geom).__geo_interface__,
-                   } for data,ID,names,geom in results)
-        return results #Matches(results)
+            select = lambda values: values and [values[i] for i in keep]
+            order = rank_candidates(cands.subset(keep), select(fclass), select(population))
+            keep = keep[order[:limit]]
+        if compact:
+            return cands.subset(keep)
+        return [self._feature(name, *rows[i]) for i in keep.tolist()]
+
+    def geocode(self, name, limit=None, bbox=None, compact=False):
+        '''If compact is True, returns the results as Candidates instead of a list of features.
+        If limit is given, returns only the limit most likely results, ranked by source agreement,
+        feature class and population where available.'''
+        if self.plain_coords:
+            match = "SELECT DISTINCT data,id FROM names WHERE name_norm = ?"
+            name_param = normalize_name(name)
+        else:
+            # NOT CORRRECT QUERY, RETURNS DUPLICATES
+            match = "SELECT data,id FROM names WHERE name = ? COLLATE NOCASE"
+            name_param = name
+        params = (name_param,)
+        where = ''
+        if bbox and self.spatial_index:
+            cond,bbox_params = self._bbox_filter(bbox)
+            where = ' AND ' + cond
+            params += bbox_params
+        rows = self.db.cursor().execute("SELECT locs.data, locs.id, GROUP_CONCAT(names.name, '|'), {geom}{rank} FROM locs, names, ({match}) AS m WHERE locs.id=m.id AND locs.data=m.data and names.id=m.id and names.data=m.data{where} GROUP BY m.data,m.id".format(geom=self.geom_fields, rank=self.rank_fields, match=match, where=where), params)
+        return self._results(name, rows, bbox, compact, limit) #Matches(results)
+
+    def geocode_fuzzy(self, name, max_distance=1, limit=None, bbox=None, compact=False):
+        '''Geocodes all gazetteer names within max_distance character edits of name, eg to allow for ocr errors.
+        Each result has the edit distance in its 'distance' property, and results are sorted by distance.
+        If limit is given, returns only the limit most likely results of the closest names.'''
+        if self.fuzzy_index is None:
+            raise Exception('Fuzzy geocoding requires a coder created with max_distance')
+        matches = self.fuzzy_index.lookup(name, max_distance)
+        if not matches:
+            return Candidates.from_rows(name, []) if compact else []
+        matchnames,dists = zip(*matches)
+        # matched names are normalized, so older dbs without normalized names need the name index to find them
+        if self.name_index is None and not self.plain_coords:
+            geocoded = self._geocode_indexed(matchnames, get_name_index(self.path), limit, bbox, compact)
+        else:
+            geocoded = self.geocode_many(matchnames, limit, bbox=bbox, compact=compact)
+        if compact:
+            parts = []
+            for matchname,dist in matches:
+                part = geocoded[matchname]
+                part.distance = np.full(len(part), dist, dtype=np.int16)
+                parts.append(part)
+            results = Candidates.concat(name, parts)
+            return results.subset(np.arange(min(limit, len(results)))) if limit else results
+        results = []
+        for matchname,dist in matches:
+            for r in geocoded[matchname]:
+                r['properties']['search'] = name
+                r['properties']['distance'] = dist
+                results.append(r)
+        return results[:limit] if limit else results
+
+    def geocode_many(self, names, limit=None, max_distance=0, bbox=None, compact=False):
+        '''Geocodes many names at once, returning a dict of each name and its list of results.
+        With the name index all names are looked up in memory and the results fetched in a single query,
+        otherwise each name is queried separately.
+        If max_distance is set, names without any exact results are geocoded with geocode_fuzzy().
+        If compact is True, the results of each name are returned as Candidates instead of a list of features.'''
+        if max_distance:
+            results = self.geocode_many(names, limit, bbox=bbox, compact=compact)
+            for name in results:
+                if not len(results[name]):
+                    results[name] = self.geocode_fuzzy(name, max_distance, limit, bbox, compact)
+            return results
+        if self.name_index is None:
+            return dict(((name, self.geocode(name, limit, bbox, compact)) for name in set(names)))
+        return self._geocode_indexed(names, self.name_index, limit, bbox, compact)
+
+    def _geocode_indexed(self, names, name_index, limit=None, bbox=None, compact=False):
+        '''Same as geocode_many(), looking up all names in a NameIndex'''
+        # lookup matching locations of all names
+        names = list(set(names))
+        rowids = name_index.lookup(names)
+
+        # fetch all matching locations at once
+        cur = self.db.cursor()
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (rid INTEGER PRIMARY KEY)')
+        cur.execute('DELETE FROM lookup')
+        cur.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', ((int(rid),) for ids in rowids for rid in ids))
+        # cross join so the lookup table is always scanned first, since it has no planner stats
+        params = ()
+        where = ''
+        if bbox and self.spatial_index:
+            cond,params = self._bbox_filter(bbox)
+            where = ' WHERE ' + cond
+        rows = cur.execute("SELECT locs.rowid, locs.data, locs.id, GROUP_CONCAT(names.name, '|'), {geom}{rank} FROM lookup CROSS JOIN locs ON locs.rowid = lookup.rid JOIN names ON names.data = locs.data AND names.id = locs.id{where} GROUP BY locs.rowid".format(geom=self.geom_fields, rank=self.rank_fields, where=where), params)
+        locs = dict(((rid,row) for rid,*row in rows))
+
+        # create results for each name
+        results = dict()
+        for name,ids in zip(names,rowids):
+            results[name] = self._results(name, [locs[rid] for rid in ids.tolist() if rid in locs], bbox, compact, limit)
+        return results
+
+
+
+class CachedCoder(object):
+    def __init__(self, coder, max_size=1000000, path=None):
+        '''Wraps any coder with a least recently used cache of geocode results, including names with no results,
+        so that names that are looked up again don't have to be geocoded from scratch.
+        Coders other than OptimizedCoder are geocoded one name at a time, with any bbox applied to their results
+        afterwards, and don't support fuzzy matching.
+        - max_size is the max number of cached results across all names, where names with no results count as one.
+        - path is an optional file the cache is loaded from, and written to with save().
+        '''
+        self.coder = coder
+        self.max_size = max_size
+        self.path = path
+        self.cache = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, 'rb') as fobj:
+                for key,results in pickle.load(fobj):
+                    self._store(key, results)
+
+    def _store(self, key, results):
+        if key in self.cache:
+            self.size -= max(1, len(self.cache.pop(key)))
+        self.cache[key] = results
+        self.size += max(1, len(results))
+        while self.size > self.max_size and len(self.cache) > 1:
+            _,dropped = self.cache.popitem(last=False)
+            self.size -= max(1, len(dropped))
+
+    def _get(self, key):
+        results = self.cache.get(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(key)
+        # copies, so callers can modify the results
+        if isinstance(results, Candidates):
+            return results.copy()
+        return [dict(r) for r in results]
+
+    def _geocode_plain(self, name, limit=None, bbox=None, compact=False):
+        # geocode a single name with a coder that only has geocode()
+        results = list(self.coder.geocode(name, limit) if limit else self.coder.geocode(name))
+        if bbox or compact:
+            cands = Candidates.from_features(name, results)
+            keep = cands.bbox_mask(bbox) if bbox else np.ones(len(cands), dtype=bool)
+            if compact:
+                return cands.subset(keep)
+            results = [r for r,k in zip(results,keep) if k]
+        return results
+
+    def geocode(self, name, limit=None, bbox=None):
+        return self.geocode_many([name], limit, bbox=bbox)[name]
+
+    def geocode_many(self, names, limit=None, max_distance=0, bbox=None, compact=False):
+        '''Same as geocode_many() of the wrapped coder, only geocoding the names not already in the cache'''
+        bbox = tuple(bbox) if bbox else None
+        key = (limit, max_distance, bbox, compact)
+        results = dict()
+        todo = []
+        for name in set(names):
+            cached = self._get((name,)+key)
+            if cached is None:
+                todo.append(name)
+            else:
+                results[name] = cached
+        if todo:
+            if isinstance(self.coder, OptimizedCoder):
+                new = self.coder.geocode_many(todo, limit, max_distance=max_distance, bbox=bbox, compact=compact)
+            elif max_distance:
+                raise Exception('Fuzzy geocoding requires an OptimizedCoder')
+            else:
+                new = dict(((name, self._geocode_plain(name, limit, bbox, compact)) for name in todo))
+            for name in todo:
+                nameresults = new[name] if compact else list(new.get(name, []))
+                self._store((name,)+key, nameresults)
+                results[name] = nameresults.copy() if compact else [dict(r) for r in nameresults]
+        return results
+
+    def save(self, path=None):
+        path = path or self.path
+        with open(path, 'wb') as fobj:
+            pickle.dump(list(self.cache.items()), fobj)
+
+_cached_coders = dict()
+
+def get_cached_coder(path=None, name_index=False, cache_path=None, max_distance=0):
+    '''Returns a CachedCoder around the OptimizedCoder for the gazetteer db at path,
+    shared by all calls in this process.'''
+    key = (path, name_index, cache_path, max_distance)
+    if key not in _cached_coders:
+        _cached_coders[key] = CachedCoder(OptimizedCoder(path, name_index=name_index, max_distance=max_distance), path=cache_path)
+    return _cached_coders[key]
 
 
 
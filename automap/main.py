@@ -2,6 +2,7 @@
 from . import segmentation
 from . import textdetect
 from . import textgroup
+from . import texttable
 from . import toponyms
 
 from . import triangulate
@@ -71,7 +72,7 @@ def image_partitioning(im):
 
     return seginfo
 
-def text_detection(text_im, textcolor, colorthresh, textconf, parallel, sample, seginfo, max_procs):
+def text_detection(text_im, textcolor, colorthresh, textconf, parallel, sample, seginfo, max_procs, ocr_cache=None, stats=None, tilesize=(500,500)):
     ###############
     # Text detection
     
@@ -79,88 +80,52 @@ def text_detection(text_im, textcolor, colorthresh, textconf, parallel, sample,
     print('(detecting text)')
     if textcolor and not isinstance(textcolor, list):
         textcolor = [textcolor]
-    texts = textdetect.auto_detect_text(text_im, textcolors=textcolor, colorthresh=colorthresh, textconf=textconf, parallel=parallel, sample=sample, seginfo=seginfo, max_procs=max_procs)
-    toponym_colors = set((r['color'] for r in texts))
+    texts = textdetect.auto_detect_text(text_im, textcolors=textcolor, colorthresh=colorthresh, textconf=textconf, parallel=parallel, sample=sample, seginfo=seginfo, max_procs=max_procs, ocr_cache=ocr_cache, stats=stats, tilesize=tilesize)
+    toponym_colors = texts.used_colors()
 
     # deduplicate overlapping texts from different colors
-    # very brute force...
     if len(toponym_colors) > 1:
         print('(deduplicating texts of different colors)')
         print('textlen',len(texts))
-        # for every combination of text colors
-        for col,col2 in itertools.combinations(toponym_colors, 2):
-            coltexts = [r for r in texts if r['color'] == col]
-            coltexts2 = [r for r in texts if r['color'] == col2]
-            print('comparing textcolor',map(int,col),len(coltexts),'with',map(int,col2),len(coltexts2))
-            # we got two different colored groups of text
-            for r in coltexts:
-                for r2 in coltexts2:
-                    # find texts that overlap
-                    if not (r['left'] > (r2['left']+r2['width']) \
-                            or (r['left']+r['width']) < r2['left'] \
-                            or r['top'] > (r2['top']+r2['height']) \
-                            or (r['top']+r['height']) < r2['top'] \
-                            ):
-                        # drop the one with the poorest color match
-                        #text_im.crop((r['left'], r['top'], r['left']+r['width'], r['top']+r['height'])).show()
-                        #text_im.crop((r2['left'], r2['top'], r2['left']+r2['width'], r2['top']+r2['height'])).show()
-                        if r2['color_match'] > r['color_match'] and not math.isnan(r2['color_match']):
-                            r2['drop'] = True
-                            print(u'found duplicate texts of different colors, keeping "{}" (color match={:.2f}), dropping "{}" (color match={:.2f})'.format(r['text_clean'],r['color_match'],r2['text_clean'],r2['color_match']))
-                        else:
-                            r['drop'] = True
-                            print(u'found duplicate texts of different colors, keeping "{}" (color match={:.2f}), dropping "{}" (color match={:.2f})'.format(r2['text_clean'],r2['color_match'],r['text_clean'],r['color_match']))
-        texts = [r for r in texts if not r.get('drop')]
+        texts = textdetect.deduplicate_texts(texts, toponym_colors)
         print('textlen deduplicated',len(texts))
 
     # connect texts
     print('(connecting texts)')
     grouped = []
+    # divide into lower and upper case subgroups
+    # upper = more than half of alpha characters is uppercase (to allow for minor ocr upper/lower errors)
+    isupper = np.array([len([ch for ch in alphachars if ch.isupper()]) > (len(alphachars) / 2.0)
+                        for alphachars in texts['text_alphas']], dtype=bool)
     # connect each color texts separately
     for col in toponym_colors:
-        coltexts = [r for r in texts if r['color'] == col]
-        # divide into lower and upper case subgroups
-        # upper = more than half of alpha characters is uppercase (to allow for minor ocr upper/lower errors)
-        lowers = []
-        uppers = []
-        for text in coltexts:
-            alphachars = text['text_alphas']
-            isupper = len([ch for ch in alphachars if ch.isupper()]) > (len(alphachars) / 2.0) 
-            if isupper:
-                uppers.append(text)
-            else:
-                lowers.append(text)
+        colmask = texts.color_mask(col)
+        lowers = texts[colmask & ~isupper]
+        uppers = texts[colmask & isupper]
         # connect lower and upper case texts separately
         if len(lowers) > 1:
-            grouped.extend( textgroup.connect_text(lowers) )
+            grouped.extend( textgroup.connect_text(lowers.to_dicts()) )
         if len(uppers) > 1:
-            grouped.extend( textgroup.connect_text(uppers) )
-    texts = grouped
+            grouped.extend( textgroup.connect_text(uppers.to_dicts()) )
+    texts = texttable.TextTable.from_dicts(grouped)
 
     # store metadata
-    textinfo = {'type': 'FeatureCollection', 'features': []}
-    for r in texts:
-        x1,y1,x2,y2 = r['left'], r['top'], r['left']+r['width'], r['top']+r['height']
-        box = [(x1,y1),(x2,y1),(x2,y2),(x1,y2),(x1,y1)]
-        geoj = {'type':'Polygon', 'coordinates':[box]}
-        props = dict(r)
-        feat = {'type':'Feature', 'geometry':geoj, 'properties':props}
-        textinfo['features'].append(feat)
+    textinfo = texts.to_geojson()
 
     return textinfo
 
-def toponym_selection(im, textinfo, seginfo):
+def toponym_selection(im, textinfo, seginfo, max_procs=None, stats=None):
     ################
     # Toponym selection
-    texts = [f['properties'] for f in textinfo['features']]
+    texts = texttable.TextTable.from_geojson(textinfo)
 
     # filter toponym candidates
     print('filtering toponym candidates')
-    topotexts = toponyms.filter_toponym_candidates(texts, seginfo)
+    topotexts = toponyms.filter_toponym_candidates(texts, seginfo, stats=stats)
 
     # text anchor points
     print('determening toponym anchors')
-    topotexts = toponyms.detect_toponym_anchors(im, texts, topotexts)
+    topotexts = toponyms.detect_toponym_anchors(im, texts, topotexts, max_workers=max_procs)
 
     # create control points from toponyms
     points = [(r['text_clean'], r['anchor']) for r in topotexts if 'anchor' in r] # if r['function']=='placename']
@@ -388,7 +353,7 @@ def warp_image(mapp_im, transinfo):
 
 ### MAIN FUNC
 
-def automap(im, outpath=True, matchthresh=0.25, textcolor=None, colorthresh=25, textconf=60, sample=False, parallel=False, max_procs=None, db=None, source='best', warp=True, warp_order=None, residual_type='pixels', max_residual=None, debug=False, priors=None, **kwargs):
+def automap(im, outpath=True, matchthresh=0.25, textcolor=None, colorthresh=25, textconf=60, sample=False, parallel=False, max_procs=None, tilesize=(500,500), ocr_cache=None, db=None, source='best', warp=True, warp_order=None, residual_type='pixels', max_residual=None, debug=False, priors=None, **kwargs):
     info = dict()
     priors = priors or dict()
     start = time.time()
@@ -447,6 +412,8 @@ def automap(im, outpath=True, matchthresh=0.25, textcolor=None, colorthresh=25,
                   sample=sample,
                   parallel=parallel,
                   max_procs=max_procs,
+                  tilesize=tilesize,
+                  ocr_cache=ocr_cache if isinstance(ocr_cache, basestring) else None,
                   source=source,
                   warp_order=warp_order,
                   residual_type=residual_type,
@@ -535,6 +502,7 @@ def automap(im, outpath=True, matchthresh=0.25, textcolor=None, colorthresh=25,
     # detect text
     print('\n' + 'detecting text')
     t = time.time()
+    textstats = dict()
     textinfo = priors.get('text_recognition', None)
     if textinfo:
         # already given
@@ -543,11 +511,13 @@ def automap(im, outpath=True, matchthresh=0.25, textcolor=None, colorthresh=25,
         # later stage given, so not necessary
         pass
     else:
-        textinfo = text_detection(text_im, textcolor, colorthresh, textconf, parallel, sample, seginfo, max_procs)
+        textinfo = text_detection(text_im, textcolor, colorthresh, textconf, parallel, sample, seginfo, max_procs, ocr_cache, textstats, tilesize)
 
     # store timing
     elaps = time.time() - t
     timinginfo['text_recognition'] = elaps
+    timinginfo['text_recognition_skipped_tiles'] = textstats.get('tiles_skipped', 0)
+    timinginfo['text_recognition_skipped_colors'] = textstats.get('colors_skipped', 0)
 
     # store metadata
     info['text_recognition'] = textinfo
@@ -569,6 +539,7 @@ def automap(im, outpath=True, matchthresh=0.25, textcolor=None, colorthresh=25,
     # text anchor points
     print('\n' + 'seleting toponyms with anchor points')
     t = time.time()
+    toponymstats = dict()
     toponyminfo = priors.get('toponym_candidates', None)
     if toponyminfo:
         # already given
@@ -577,11 +548,13 @@ def automap(im, outpath=True, matchthresh=0.25, textcolor=None, colorthresh=25,
         # later stage given, so not necessary
         pass
     else:
-        toponyminfo = toponym_selection(im, textinfo, seginfo)
+        toponyminfo = toponym_selection(im, textinfo, seginfo, max_procs, toponymstats)
 
     # store timing
     elaps = time.time() - t
     timinginfo['toponym_candidates'] = elaps
+    for rule,dropped in toponymstats.items():
+        timinginfo['toponym_candidates_'+rule] = dropped
 
     # store metadata
     info['toponym_candidates'] = toponyminfo
@@ -0,0 +1,130 @@
+"""
+On-disk cache of text recognition results, so that repeated runs on the
+same image tiles don't have to rerun the OCR.
+"""
+
+import sqlite3
+import hashlib
+import json
+import time
+
+import numpy as np
+
+
+def hash_image(im):
+    '''Returns a hash of the pixel contents of a PIL image or numpy array'''
+    arr = np.ascontiguousarray(np.asarray(im))
+    h = hashlib.sha1(arr.tobytes())
+    h.update(repr(arr.shape).encode('utf8'))
+    return h.hexdigest()
+
+
+class OCRCache(object):
+    def __init__(self, path, max_size=1024**3, touch_interval=3600, touch_batch=100):
+        '''Stores text results in a sqlite db at path, with least recently used entries
+        evicted once the total size of the stored results exceeds max_size bytes.
+        The total size is kept up to date by triggers, so it doesn't have to be summed on every insert.
+        To avoid a write for every cache hit, access times are only updated if older than touch_interval
+        seconds, and are written in batches of touch_batch hits or with the next set().
+        Can be pickled and passed to other processes, which will open their own connection.'''
+        self.path = path
+        self.max_size = max_size
+        self.touch_interval = touch_interval
+        self.touch_batch = touch_batch
+        self._db = None
+        self._touched = []
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None # connections can't be pickled
+        state['_touched'] = []
+        return state
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute('CREATE TABLE IF NOT EXISTS texts (key TEXT PRIMARY KEY, data TEXT, size INTEGER, accessed REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS texts_accessed ON texts (accessed)')
+            # running total of stored sizes, also for caches created before it was added
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER)')
+            self._db.execute('INSERT OR IGNORE INTO meta VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM texts))')
+            self._db.execute('CREATE TRIGGER IF NOT EXISTS texts_insert AFTER INSERT ON texts BEGIN UPDATE meta SET total = total + NEW.size; END')
+            self._db.execute('CREATE TRIGGER IF NOT EXISTS texts_delete AFTER DELETE ON texts BEGIN UPDATE meta SET total = total - OLD.size; END')
+            self._db.commit()
+        return self._db
+
+    def make_key(self, *params):
+        '''Creates a cache key from any number of json serializable parameters, eg tile hash,
+        text color, threshold, etc. Floats are rounded to avoid precision differences.'''
+        def norm(v):
+            if isinstance(v, (list,tuple)):
+                return [norm(_v) for _v in v]
+            elif isinstance(v, float):
+                return round(v, 3)
+            elif isinstance(v, np.generic):
+                return norm(v.item())
+            return v
+        params = json.dumps(norm(list(params)))
+        return hashlib.sha1(params.encode('utf8')).hexdigest()
+
+    def get(self, key):
+        '''Returns the cached list of text dicts for key, or None if not in cache'''
+        row = self.db.execute('SELECT data, accessed FROM texts WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        data,accessed = row
+        now = time.time()
+        if now - accessed > self.touch_interval:
+            self._touched.append((now, key))
+            if len(self._touched) >= self.touch_batch:
+                self.flush()
+        return json.loads(data)
+
+    def flush(self):
+        '''Writes any pending access time updates'''
+        if self._touched:
+            self.db.executemany('UPDATE texts SET accessed = ? WHERE key = ?', self._touched)
+            self.db.commit()
+            self._touched = []
+
+    def set(self, key, texts):
+        '''Stores a list of text dicts for key, and evicts the least recently used results
+        if the cache exceeds its max size'''
+        data = json.dumps(texts)
+        if self._touched:
+            self.db.executemany('UPDATE texts SET accessed = ? WHERE key = ?', self._touched)
+            self._touched = []
+        # delete and insert instead of replace, so the size triggers fire for both
+        self.db.execute('DELETE FROM texts WHERE key = ?', (key,))
+        self.db.execute('INSERT INTO texts VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+        total = self.size()
+        if total > self.max_size:
+            self.evict(total)
+        self.db.commit()
+
+    def size(self):
+        return self.db.execute('SELECT total FROM meta').fetchone()[0]
+
+    def evict(self, total=None):
+        if total is None:
+            total = self.size()
+        if total <= self.max_size:
+            return
+        cur = self.db.execute('SELECT key, size FROM texts ORDER BY accessed')
+        drop = []
+        for key,size in cur:
+            drop.append((key,))
+            total -= size
+            if total <= self.max_size:
+                break
+        self.db.executemany('DELETE FROM texts WHERE key = ?', drop)
+
+    def clear(self):
+        self._touched = []
+        self.db.execute('DELETE FROM texts')
+        self.db.commit()
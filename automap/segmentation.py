@@ -21,50 +21,93 @@ def rgb_to_lab(im):
     im = ImageCms.applyTransform(im, rgb2lab)
     return im
 
-def color_difference(im, color):
-    im_arr = np.array(im)
-
-    # If wanna do larger more quicker, then do it tiled, eg:
-##    tw,th = 300,300
-##    diff = np.zeros(tuple(reversed(im.size)))
-##    for y in range(0,im.size[1],th):
-##        print y
-##        for x in range(0,im.size[0],tw):
-##            x2 = min(x + tw, im.size[0])
-##            y2 = min(y + th, im.size[1])
-##            tile = im.crop([x,y,x2,y2])
-##            tdiff = mapfit.segmentation.color_difference(tile, col)
-##            tdiff[tdiff>thresh] = 255
-##            diff[y:y2, x:x2] = tdiff
-##    Image.fromarray(diff).show()
-
-    #target = color
-    #diffs = [pairdiffs[tuple(sorted([target,oth]))] for oth in colors if oth != target]
-
-    target = convert_color(sRGBColor(*color, is_upscaled=True), LabColor).get_value_tuple()
-    counts,colors = zip(*im.getcolors(256)) # somehow much faster than numpy... 
-    #colors,counts = np.unique(im_arr.reshape(-1, 3), return_counts=True, axis=0)
-    colors,counts = list(map(tuple,colors)), list(map(int,counts))
-    colors_lab = [convert_color(sRGBColor(*col, is_upscaled=True), LabColor).get_value_tuple()
-                  for col in colors]
-    diffs = delta_e_cie2000(target, np.array(colors_lab))
-    
-    difftable = dict(list(zip(colors,diffs)))
-    diff_im = np.zeros((im.height,im.width))
-    im_arr_idx = im_arr.dot(np.array([1, 256, 65536])) #im_arr[:,:,0] + (im_arr[:,:,1]*256) + (im_arr[:,:,2]*256*256)
-    for col,diff in difftable.items():
-        #print col
-        
-        #diff_im[(im_arr[:,:,0]==col[0])&(im_arr[:,:,1]==col[1])&(im_arr[:,:,2]==col[2])] = diff # 3 lookup is slow
+# sRGB (D65) constants, same as used by colormath's sRGBColor -> LabColor conversion
+SRGB_TO_XYZ = np.array([[0.412424, 0.357579, 0.180464],
+                        [0.212656, 0.715158, 0.0721856],
+                        [0.0193324, 0.119193, 0.950444]])
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+CIE_E = 216/24389.0
+
+def colors_to_lab(colors):
+    '''Vectorized conversion of a sequence of upscaled (0-255) rgb colors to Lab,
+    giving the same values as converting each color via colormath.
+    Returns a (n,3) float array.'''
+    rgb = np.asarray(colors, dtype=np.float64).reshape((-1,3)) / 255.0
+    # linearize
+    lin = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    # to xyz, relative to the reference white
+    xyz = lin.dot(SRGB_TO_XYZ.T) / D65_WHITE
+    # to lab
+    f = np.where(xyz > CIE_E, np.cbrt(xyz), (7.787 * xyz) + (16.0 / 116.0))
+    l = (116.0 * f[:,1]) - 16.0
+    a = 500.0 * (f[:,0] - f[:,1])
+    b = 200.0 * (f[:,1] - f[:,2])
+    return np.stack([l,a,b], axis=1)
+
+def palette_indices(im):
+    '''Returns the palette index image and the (n,3) rgb palette of an image.
+    For 'P' images (eg from quantize()) these are read directly, otherwise the image
+    must have no more than 256 unique colors.'''
+    if im.mode == 'P':
+        idx = np.array(im)
+        palette = np.array(im.getpalette()[:768], dtype=np.uint8).reshape((-1,3))
+        return idx, palette
+
+    # look up each pixel's position in the sorted list of unique colors
+    im = im.convert('RGB')
+    colors = im.getcolors(256) # somehow much faster than numpy... 
+    if colors is None:
+        raise ValueError('Image must be quantized to max 256 colors before calculating color differences')
+    counts,colors = zip(*colors)
+    palette = np.array(colors, dtype=np.uint32)
+    packed = palette[:,0] + (palette[:,1]*256) + (palette[:,2]*65536)
+    order = np.argsort(packed)
+    palette,packed = palette[order],packed[order]
+    im_arr = np.array(im).astype(np.uint32)
+    im_arr_packed = im_arr[:,:,0] + (im_arr[:,:,1]*256) + (im_arr[:,:,2]*65536)
+    idx = np.searchsorted(packed, im_arr_packed).astype(np.uint8)
+    return idx, palette.astype(np.uint8)
+
+def palette_difference(palette, color):
+    '''Calculates the CIE2000 color difference between each color of an (n,3) rgb palette and a target color.
+    Returns a float32 array of length n, for looking up the differences of palette index images.'''
+    target = colors_to_lab([color])[0]
+    palette_lab = colors_to_lab(palette)
+    return delta_e_cie2000(target, palette_lab).astype(np.float32)
 
-        #wherecolor = (im_arr==col).all(axis=2) 
-        #diff_im[wherecolor] = diff
+def color_difference(im, color):
+    '''Calculates the CIE2000 color difference between each pixel and a target color.
+    The image should be a 'P' image from quantize(), since differences are only calculated once
+    for each palette color and then looked up for each pixel.
+    Returns a float32 array of the same height and width as the image.'''
+    idx,palette = palette_indices(im)
 
-        wherecolor = im_arr_idx == (col[0] + (col[1]*256) + (col[2]*256*256))
-        diff_im[wherecolor] = diff
+    # calc diff for each palette color
+    lut = palette_difference(palette, color)
 
+    # lookup diff for each pixel
+    diff_im = lut[idx]
     return diff_im
 
+def color_difference_stack(im, colors, dtype=np.float32):
+    '''Same as color_difference() but for multiple target colors at once, sharing a single
+    pass over the palette indices of the image.
+    Returns a (n_colors,height,width) array of differences. If dtype is np.uint8 the differences
+    are rounded and capped at 255 to save memory.'''
+    idx,palette = palette_indices(im)
+
+    # calc diff table for each target and palette color
+    targets = colors_to_lab(colors)
+    palette_lab = colors_to_lab(palette)
+    lut = np.array([delta_e_cie2000(target, palette_lab) for target in targets])
+    if np.dtype(dtype) == np.uint8:
+        lut = np.clip(np.round(lut), 0, 255)
+    lut = lut.astype(dtype)
+
+    # lookup diffs for each pixel
+    diff_stack = lut[:, idx]
+    return diff_stack
+
 def color_differences(colors):
     colors_lab = [convert_color(sRGBColor(*col, is_upscaled=True), LabColor).get_value_tuple()
                   for col in colors]
@@ -124,7 +167,7 @@ def view_colors(colors):
     c.get_image().show()
 
 def quantize(im):
-    quant = im.convert('P', palette=PIL.Image.ADAPTIVE, colors=256).convert('RGB')
+    quant = im.convert('P', palette=PIL.Image.ADAPTIVE, colors=256)
     return quant
 
 def mask_image(im, poly, invert=False):
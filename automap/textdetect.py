@@ -1,11 +1,24 @@
 
 from . import segmentation
+from . import toponyms
+from . import ocrcache
+from . import texttable
 
 import numpy as np
 import PIL, PIL.Image
 from PIL import ImageOps
 
+import os
 import re
+import math
+import atexit
+import itertools
+import multiprocessing as mp
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import pytesseract
 
@@ -19,31 +32,152 @@ except:
 #pytesseract.pytesseract.tesseract_cmd = 'C:/Program Files/Tesseract-OCR/tesseract'
 
 
+TSV_FIELDS = 'level page_num block_num par_num line_num word_num left top width height conf text'.split()
+
+class OCRPool(object):
+    def __init__(self, size=None, lang='eng'):
+        '''Pool of long-lived tesseract engines, using the tesserocr C API bindings.
+        Engines are started lazily as needed, up to size engines, and are then reused
+        across calls so that the language data only has to be loaded once.
+        A pool belongs to the process that created it, see get_ocr_pool().'''
+        import tesserocr
+        import threading
+        self.tesserocr = tesserocr
+        self.size = size or mp.cpu_count()
+        self.lang = lang
+        self.engines = queue.Queue()
+        self.started = 0
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def close(self):
+        if os.getpid() != self.pid:
+            return # copy inherited by a forked process, the engines belong to the parent
+        while self.started:
+            engine = self.engines.get()
+            engine.End()
+            self.started -= 1
+
+    def acquire(self):
+        # reuse an idle engine or start a new one if below pool size
+        with self.lock:
+            if self.engines.empty() and self.started < self.size:
+                self.started += 1
+                return self.tesserocr.PyTessBaseAPI(lang=self.lang)
+        return self.engines.get()
+
+    def release(self, engine):
+        self.engines.put(engine)
+
+    def image_to_data(self, im, mode=11):
+        '''Same as pytesseract.image_to_data(), but takes either a PIL image or numpy array
+        and passes the raw pixel buffer to the engine without encoding it to file.'''
+        arr = np.ascontiguousarray(np.asarray(im, dtype=np.uint8))
+        h,w = arr.shape[:2]
+        bpp = arr.shape[2] if arr.ndim == 3 else 1
+        engine = self.acquire()
+        try:
+            engine.SetPageSegMode(mode)
+            engine.SetImageBytes(arr.tobytes(), w, h, bpp, w*bpp)
+            engine.Recognize()
+            data = engine.GetTSVText(0)
+        finally:
+            engine.Clear()
+            self.release(engine)
+        # same format as the pytesseract output, which includes a header
+        data = '\t'.join(TSV_FIELDS) + '\n' + data
+        return data
+
+_ocr_pool = None
+
+def get_ocr_pool():
+    '''Returns the OCR engine pool shared by all OCR calls in this process,
+    or None if tesserocr is not installed (in which case pytesseract is used).
+    Forked processes, eg multiprocessing workers, get a new pool of their own instead of the
+    inherited copy, whose engine queue, count, and lock are only a snapshot of the parent's.'''
+    global _ocr_pool
+    if _ocr_pool is None or (_ocr_pool and _ocr_pool.pid != os.getpid()):
+        try:
+            _ocr_pool = OCRPool()
+            atexit.register(_ocr_pool.close)
+        except ImportError:
+            _ocr_pool = False
+    return _ocr_pool or None
+
+_ocr_version = None
+
+def ocr_version():
+    '''Returns the version string of the tesseract engine used for OCR'''
+    global _ocr_version
+    if _ocr_version is None:
+        if get_ocr_pool():
+            import tesserocr
+            _ocr_version = tesserocr.tesseract_version()
+        else:
+            _ocr_version = str(pytesseract.get_tesseract_version())
+    return _ocr_version
+
+def parse_tsv(data):
+    '''Parses the tsv output of tesseract to a texttable.TextTable,
+    converting each numeric field as a whole column instead of value by value.'''
+    lines = data.split('\n')
+    fields = lines.pop(0).split('\t')
+    rows = [line.split('\t') for line in lines]
+    rows = [row for row in rows if len(row) == len(fields)]
+    columns = list(zip(*rows)) if rows else [[] for _ in fields]
+
+    texts = texttable.TextTable()
+    for k,col in zip(fields, columns):
+        if k == 'text':
+            texts[k] = list(col)
+        elif k == 'conf':
+            texts[k] = np.array(col, dtype=np.float64)
+        else:
+            texts[k] = np.array(col, dtype=np.int32)
+    texts['fontheight'] = texts['height'].copy()
+    return texts
+
 def run_ocr(im, bbox=None, mode=11):
+    '''Runs tesseract on a PIL image or numpy array, optionally cropped to bbox.
+    Returns a texttable.TextTable.'''
     if bbox:
         xoff,yoff = bbox[:2]
-        im = im.crop(bbox)
-    data = pytesseract.image_to_data(im, lang='eng', config='--psm {}'.format(mode)) # +equ
+        if isinstance(im, np.ndarray):
+            x1,y1,x2,y2 = bbox
+            im = im[y1:y2, x1:x2]
+        else:
+            im = im.crop(bbox)
+    pool = get_ocr_pool()
+    if pool:
+        data = pool.image_to_data(im, mode)
+    else:
+        if isinstance(im, np.ndarray):
+            im = PIL.Image.fromarray(im)
+        data = pytesseract.image_to_data(im, lang='eng', config='--psm {}'.format(mode)) # +equ
     #data = pytesseract.image_to_data(im, lang='eng+fra', config='--psm {} --tessdata-dir "{}"'.format(mode, r'C:\Users\kimok\Desktop\tessdata_fast')) # +equ
-    drows = [[v for v in row.split('\t')] for row in data.split('\n')]
-    dfields = drows.pop(0)
-    drows = [dict(zip(dfields,row)) 
-            for row in drows
-            if len(row) == len(dfields)]
+    texts = parse_tsv(data)
     
-    # some standardizations
-    for d in drows:
-        for k in 'left top width height'.split():
-            d[k] = int(d[k])
-        if bbox:
-            d['left'] += xoff
-            d['top'] += yoff
-        d['conf'] = float(d['conf'])
-        d['fontheight'] = d['height']
+    # offset to coords of the uncropped image
+    if bbox:
+        texts.offset(xoff, yoff)
         
-    return drows
+    return texts
 
-def refine_textbox(im_arr, textdata):
+def hist_bounds(hist):
+    '''Returns the first and last index where a histogram reaches more than 90% of its above-avg mean,
+    or None if it never does.'''
+    hist = np.asarray(hist)
+    histmean = hist.mean()
+    above = hist[hist > histmean]
+    if not len(above):
+        return None
+    histthresh = above.mean() * 0.9
+    reached = np.flatnonzero(hist >= histthresh)
+    return reached[0], reached[-1]
+
+def refine_textbox(im_arr, textdata, hists=None):
+    '''Refines the bbox of an ocr text based on the row and column histograms of non-white pixels.
+    hists can be given as a precalculated (rows,cols) tuple, see refine_textboxes().'''
     x,y = textdata['left'],textdata['top']
     w,h = textdata['width'],textdata['height']
 
@@ -75,65 +209,43 @@ def refine_textbox(im_arr, textdata):
     if debug and histdebug:
         PIL.Image.fromarray(255-im_box).show()
 
-    # calc y hist
-    horiz = []
-    ys = list(range(y, y+h))
-    for boxy in range(im_box.shape[0]):
-        summ = (im_box[boxy,:] < 255).sum()
-        horiz.append(summ)
+    # calc y and x hists
+    if hists:
+        horiz,vertic = hists
+    else:
+        ink = im_box < 255
+        horiz = ink.sum(axis=1)
+        vertic = ink.sum(axis=0)
 
     # define upper and lower font core as first and last time hist reaches more than 90% of above-avg mean
-    histmean = np.mean(horiz)
-    histmeanpos = np.mean([v for v in horiz if v > histmean])
-    histthresh = histmeanpos * 0.9
+    ys = np.arange(y, y+len(horiz))
     ystart = textdata['top']
-    for y,ycount in zip(ys,horiz):
-        if ycount >= histthresh:
-            ystart = y
-            break
     yend = textdata['top'] + textdata['height']
-    for y,ycount in reversed(list(zip(ys,horiz))):
-        if ycount >= histthresh:
-            yend = y
-            break
+    bounds = hist_bounds(horiz)
+    if bounds:
+        ystart,yend = int(ys[bounds[0]]), int(ys[bounds[1]])
 
     # view
     if debug and histdebug:
         import matplotlib.pyplot as plt
         plt.gca().invert_yaxis()
         plt.barh(ys, horiz)
-        plt.axvline(histthresh, color='blue')
         plt.axhline(ystart, color='black')
         plt.axhline(yend, color='black')
         plt.show()
 
-    # calc x hist
-    vertic = []
-    xs = list(range(x, x+w))
-    for x in range(im_box.shape[1]):
-        summ = (im_box[:,x] < 255).sum()
-        vertic.append(summ)
-
     # define left and right text boundary as first and last time hist reaches more than 90% of above-avg mean
-    histmean = np.mean(vertic)
-    histmeanpos = np.mean([v for v in vertic if v > histmean])
-    histthresh = histmeanpos * 0.9
+    xs = np.arange(x, x+len(vertic))
     xstart = textdata['left']
-    for x,xcount in zip(xs,vertic):
-        if xcount >= histthresh:
-            xstart = x
-            break
     xend = textdata['left'] + textdata['width']
-    for x,xcount in reversed(list(zip(xs,vertic))):
-        if xcount >= histthresh:
-            xend = x
-            break
+    bounds = hist_bounds(vertic)
+    if bounds:
+        xstart,xend = int(xs[bounds[0]]), int(xs[bounds[1]])
 
     # view
     if debug and histdebug:
         import matplotlib.pyplot as plt
         plt.bar(xs, vertic)
-        plt.axhline(histthresh, color='blue')
         plt.axvline(xstart, color='black')
         plt.axvline(xend, color='black')
         plt.show()
@@ -216,9 +328,32 @@ def refine_textbox(im_arr, textdata):
 
     return textdata
 
-def sniff_text_colors(im, seginfo=None, min_samples=4, max_samples=4+4**2, max_texts=3):
+def refine_textboxes(im_arr, texts):
+    '''Batched version of refine_textbox() for all texts from the same ocr image.
+    Row and column histograms are taken from cumulative sums of non-white pixels calculated once
+    for the entire image, instead of summing the pixels of each box.'''
+    if not texts:
+        return texts
+    ink = im_arr < 255
+    dtype = np.uint16 if max(ink.shape) < 2**16 else np.uint32
+    rowcum = np.zeros((ink.shape[0], ink.shape[1]+1), dtype=dtype)
+    np.cumsum(ink, axis=1, out=rowcum[:,1:])
+    colcum = np.zeros((ink.shape[0]+1, ink.shape[1]), dtype=dtype)
+    np.cumsum(ink, axis=0, out=colcum[1:,:])
+
+    refined = []
+    for text in texts:
+        x,y = text['left'],text['top']
+        x2 = min(x+text['width'], ink.shape[1])
+        y2 = min(y+text['height'], ink.shape[0])
+        horiz = rowcum[y:y2, x2].astype(int) - rowcum[y:y2, x]
+        vertic = colcum[y2, x:x2].astype(int) - colcum[y, x:x2]
+        refined.append(refine_textbox(im_arr, text, hists=(horiz,vertic)))
+    return refined
+
+def map_bbox(im, seginfo=None):
+    '''Returns the bbox of the map region if available in seginfo, otherwise of the entire image'''
     w,h = im.size
-
     xmin,ymin,xmax,ymax = 0,0,w,h
     if seginfo:
         mapregion = next((f['geometry'] for f in seginfo['features'] if f['properties']['type'] == 'Map'), None)
@@ -226,64 +361,125 @@ def sniff_text_colors(im, seginfo=None, min_samples=4, max_samples=4+4**2, max_t
             xs,ys = zip(*[p for p in mapregion['coordinates'][0]])
             xmin,ymin,xmax,ymax = min(xs),min(ys),max(xs),max(ys)
     bbox = [xmin,ymin,xmax,ymax]
-    print('sniffing inside', bbox)
-
-    sw,sh = 300,300
-    
+    return bbox
+
+def filter_edge_texts(texts, box):
+    '''Drops any text closer than 1x fontheight away from the edges of the box region.
+    Texts is a texttable.TextTable.'''
+    if not len(texts):
+        return texts
+    fh = texts['fontheight']
+    keep = (texts['left'] >= (box[0] + fh)) \
+           & (texts['top'] >= (box[1] + fh)) \
+           & (texts.right <= (box[2] - fh)) \
+           & (texts.bottom <= (box[3] - fh))
+    return texts[keep]
+
+def deduplicate_texts(texts, colors=None):
+    '''Drops overlapping texts of different colors, keeping the one with the best color match.
+    Overlap candidates are found via a grid index of text bboxes.
+    - texts is a texttable.TextTable.
+    - colors is the order in which text colors are compared, and only matters for ties.
+    '''
+    if not len(texts):
+        return texts
+    if colors is None:
+        colors = texts.used_colors()
+    # order of each text's color
+    colorindex = dict(((col,i) for i,col in enumerate(colors)))
+    colorcodes = texts['color']
+    colororder = np.array([colorindex.get(col, -1) for col in texts.colors])[colorcodes]
+    colormatch = texts['color_match']
+    lefts,tops,rights,bottoms = texts['left'],texts['top'],texts.right,texts.bottom
+
+    # bucket texts into grid cells, sized after the typical text width
+    cellsize = max(1, int(np.median(texts['width'])))
+    grid = dict()
+    cells = zip(lefts // cellsize, rights // cellsize, tops // cellsize, bottoms // cellsize)
+    for i,(cx1,cx2,cy1,cy2) in enumerate(cells):
+        for cx in range(int(cx1), int(cx2) + 1):
+            for cy in range(int(cy1), int(cy2) + 1):
+                grid.setdefault((cx,cy), []).append(i)
+
+    # compare texts of different colors that share a cell
+    compared = set()
+    drop = set()
+    for cellidxs in grid.values():
+        for i,i2 in itertools.combinations(cellidxs, 2):
+            if colorcodes[i] == colorcodes[i2] or (i,i2) in compared:
+                continue
+            compared.add((i,i2))
+            if lefts[i] > rights[i2] or rights[i] < lefts[i2] \
+               or tops[i] > bottoms[i2] or bottoms[i] < tops[i2]:
+                continue
+            # drop the one with the poorest color match
+            if colororder[i] > colororder[i2]:
+                i,i2 = i2,i
+            if colormatch[i2] > colormatch[i] and not math.isnan(colormatch[i2]):
+                drop.add(i2)
+            else:
+                drop.add(i)
+
+    print('found {} duplicate texts of different colors'.format(len(drop)))
+    keep = np.ones(len(texts), dtype=bool)
+    keep[list(drop)] = False
+    return texts[keep]
+
+def sniff_sample(im, q):
+    '''Runs ocr on a single quad sample of the image, returning the text, color, color difference,
+    and (width,height) of each good example text.'''
     texts = []
-    for i,q in enumerate(segmentation.sample_quads(bbox, (sw,sh))):
-        print('# sample',i,q)
 
-        # crop sample of image
-        x1,y1,x2,y2 = q.bbox()
-        sample = im.crop((x1,y1,x2,y2))
+    # crop sample of image
+    x1,y1,x2,y2 = q.bbox()
+    sample = im.crop((x1,y1,x2,y2))
 
-        # convert to luminance
-        lab = segmentation.rgb_to_lab(sample)
-        l,a,b = lab.split()
+    # convert to luminance
+    lab = segmentation.rgb_to_lab(sample)
+    l,a,b = lab.split()
 
-        # upscale and run ocr
-        lup = l.resize((l.size[0]*2,l.size[1]*2), PIL.Image.LANCZOS)
-        #lup.show()
-        data = run_ocr(lup)
+    # upscale and run ocr
+    lup = l.resize((l.size[0]*2,l.size[1]*2), PIL.Image.LANCZOS)
+    #lup.show()
+    data = run_ocr(lup)
 
-        # loop detected texts
-        for text in data:
-            #print '---',text
+    # loop detected texts
+    for text in data:
+        #print '---',text
 
-            # samples must be good examples
-            if text['conf'] > 60 and len(text['text']) >= 4:
-                
-                # found text, crop img
-                #print 'SNIFFING text',text
-                top,left = text['top'],text['left']
-                width,height = text['width'],text['height']
-                textbox = left/2.0,top/2.0,left/2.0+width/2.0,top/2.0+height/2.0
-                textim = sample.crop(textbox)
-                #textim.show()
-
-                # get color values and luminance
-                rgbs = np.array(textim).reshape((textim.size[0]*textim.size[1],3))
-                rs,gs,bs = rgbs[:,0],rgbs[:,1],rgbs[:,2]
-                textlum = l.crop(textbox)
-                #textlum.show()
-
-                # equalize luminance and ignore the bottom 66% luminant pixels
-                textlum = ImageOps.equalize(textlum)
-                ls = np.array(textlum)
-                ls = 1 - ((ls.flatten()-ls.min()) / float(ls.max()-ls.min()))
-                ls_top = ls.copy()
-                ls_top[ls < 0.66] = 0
-                #PIL.Image.fromarray((ls_top*255).reshape((textim.size[1], textim.size[0]))).show()
-
-                # get luminance weighted avg of colors
-                r = np.average(rs, weights=ls_top)
-                g = np.average(gs, weights=ls_top)
-                b = np.average(bs, weights=ls_top)
-                textcol = (r,g,b)
-                #segmentation.view_colors([textcol])
-                
-                # avg smoothed midline approach
+        # samples must be good examples
+        if text['conf'] > 60 and len(text['text']) >= 4:
+            
+            # found text, crop img
+            #print 'SNIFFING text',text
+            top,left = text['top'],text['left']
+            width,height = text['width'],text['height']
+            textbox = left/2.0,top/2.0,left/2.0+width/2.0,top/2.0+height/2.0
+            textim = sample.crop(textbox)
+            #textim.show()
+
+            # get color values and luminance
+            rgbs = np.array(textim).reshape((textim.size[0]*textim.size[1],3))
+            rs,gs,bs = rgbs[:,0],rgbs[:,1],rgbs[:,2]
+            textlum = l.crop(textbox)
+            #textlum.show()
+
+            # equalize luminance and ignore the bottom 66% luminant pixels
+            textlum = ImageOps.equalize(textlum)
+            ls = np.array(textlum)
+            ls = 1 - ((ls.flatten()-ls.min()) / float(ls.max()-ls.min()))
+            ls_top = ls.copy()
+            ls_top[ls < 0.66] = 0
+            #PIL.Image.fromarray((ls_top*255).reshape((textim.size[1], textim.size[0]))).show()
+
+            # get luminance weighted avg of colors
+            r = np.average(rs, weights=ls_top)
+            g = np.average(gs, weights=ls_top)
+            b = np.average(bs, weights=ls_top)
+            textcol = (r,g,b)
+            #segmentation.view_colors([textcol])
+            
+            # avg smoothed midline approach
 ##                    foreground = textim.filter(ImageFilter.MinFilter(3))
 ##                    avg = foreground.filter(ImageFilter.BoxBlur(7))
 ##                    #avg.show()
@@ -300,45 +496,79 @@ def sniff_text_colors(im, seginfo=None, min_samples=4, max_samples=4+4**2, max_t
 ##                    #print cols
 ##                    textcol = cols[0][0]
 
-                #foreground = textim.filter(ImageFilter.MinFilter(5)) # darkest
-                #foreground.show()
-                #hist = foreground.getcolors(textim.size[0]*textim.size[1])
+            #foreground = textim.filter(ImageFilter.MinFilter(5)) # darkest
+            #foreground.show()
+            #hist = foreground.getcolors(textim.size[0]*textim.size[1])
 
-                #midline = np.array(textim)[textim.size[1]/2,:,:]
-                #cols,counts = np.unique(midline, axis=0, return_counts=True)
-                #cols = map(tuple, cols)
-                #hist = zip(counts,cols)
-                
-                #hist = sorted(hist, key=lambda(c,rgb): -c)
-                #textcol = hist[0][1]
-
-                # get luminance weighted avg of color diff from detected color
-                # (TODO: maybe should be mean+std?)
-                # (TODO: switch so only based on the same pixels that made up the color detection, ie weighted avg of top 66% of luminance pixels)
-                textim = segmentation.quantize(textim)
-                diff_arr = segmentation.color_difference(textim, textcol)
-                ls_top = ls.copy()
-                ls_top[ls < 0.33] = 0 # lower, to also include distance required to capture edge pixels
-                #PIL.Image.fromarray((ls_top*255).reshape((textim.size[1], textim.size[0]))).show()
-
-                coldiff = np.average(diff_arr.flatten(), weights=ls_top)
-                
-                #maskdiffs = diff_arr.flatten()[ls > 0.33]
-                #print text['text'], textcol, maskdiffs.mean(), np.std(maskdiffs), maskdiffs.max()
-                #coldiff = maskdiffs.max()
-                
-                #diff_arr[ls.reshape(diff_arr.shape)==0] = 255.0
-                #PIL.Image.fromarray(diff_arr).show()
-                #textarr = np.array(textim)
-                #textarr[diff_arr>coldiff] = (255,255,255)
-                #PIL.Image.fromarray(textarr).show()
-                
-                #print textcol
-                texts.append((text['text'],textcol,coldiff))
-                
-        if (i+1) >= min_samples: # minimum quad samples
-            if len(texts) >= max_texts or (i+1) >= max_samples:
-                break
+            #midline = np.array(textim)[textim.size[1]/2,:,:]
+            #cols,counts = np.unique(midline, axis=0, return_counts=True)
+            #cols = map(tuple, cols)
+            #hist = zip(counts,cols)
+            
+            #hist = sorted(hist, key=lambda(c,rgb): -c)
+            #textcol = hist[0][1]
+
+            # get luminance weighted avg of color diff from detected color
+            # (TODO: maybe should be mean+std?)
+            # (TODO: switch so only based on the same pixels that made up the color detection, ie weighted avg of top 66% of luminance pixels)
+            textim = segmentation.quantize(textim)
+            diff_arr = segmentation.color_difference(textim, textcol)
+            ls_top = ls.copy()
+            ls_top[ls < 0.33] = 0 # lower, to also include distance required to capture edge pixels
+            #PIL.Image.fromarray((ls_top*255).reshape((textim.size[1], textim.size[0]))).show()
+
+            coldiff = np.average(diff_arr.flatten(), weights=ls_top)
+            
+            #maskdiffs = diff_arr.flatten()[ls > 0.33]
+            #print text['text'], textcol, maskdiffs.mean(), np.std(maskdiffs), maskdiffs.max()
+            #coldiff = maskdiffs.max()
+            
+            #diff_arr[ls.reshape(diff_arr.shape)==0] = 255.0
+            #PIL.Image.fromarray(diff_arr).show()
+            #textarr = np.array(textim)
+            #textarr[diff_arr>coldiff] = (255,255,255)
+            #PIL.Image.fromarray(textarr).show()
+            
+            #print textcol
+            texts.append((text['text'],textcol,coldiff,(width/2.0,height/2.0))) # downscale size from upscaled coords
+
+    return texts
+
+def sniff_text_colors(im, seginfo=None, min_samples=4, max_samples=4+4**2, max_texts=3, textsizes=None, max_workers=None):
+    '''Samples are processed by a pool of max_workers threads, and any remaining samples are cancelled
+    once enough texts have been found.
+    If textsizes is a list, the (width,height) of each sampled text is appended to it.'''
+    bbox = map_bbox(im, seginfo)
+    print('sniffing inside', bbox)
+
+    sw,sh = 300,300
+
+    # queue all samples in sample order
+    # (ocr runs outside the gil so threads are sufficient)
+    from concurrent.futures import ThreadPoolExecutor
+    quads = list(itertools.islice(segmentation.sample_quads(bbox, (sw,sh)), max_samples))
+    im.load() # decode lazily opened images once, instead of concurrently in each thread's crop
+    executor = ThreadPoolExecutor(max_workers or mp.cpu_count())
+    futures = [executor.submit(sniff_sample, im, q) for q in quads]
+    
+    texts = []
+    try:
+        for i,(q,fut) in enumerate(zip(quads,futures)):
+            print('# sample',i,q)
+            for text,textcol,coldiff,textsize in fut.result():
+                texts.append((text,textcol,coldiff))
+                if textsizes is not None:
+                    textsizes.append(textsize)
+
+            if (i+1) >= min_samples: # minimum quad samples
+                if len(texts) >= max_texts or (i+1) >= max_samples:
+                    break
+    finally:
+        # cancel any samples not yet started, and wait for the running ones so no ocr threads
+        # are left holding engines if the caller goes on to fork worker processes
+        for fut in futures:
+            fut.cancel()
+        executor.shutdown(wait=True)
 
     # group similar textcolors and return
     textcolors = [t[1] for t in texts]
@@ -352,122 +582,144 @@ def sniff_text_colors(im, seginfo=None, min_samples=4, max_samples=4+4**2, max_t
         colorgroups[col] = [(subcol,coldiffs[textcolors.index(subcol)]) for subcol in colorgroups[col]]
     return colorgroups
 
-##def sample_texts(im, textcolors, threshold=25, textconf=60, samplesize=(300,300), max_samples=8, max_texts=10):
-##    # REMEMBER: update text processing/filtering to be same as extract_texts(), maybe by calling it?
-##    # ...
-##    raise Exception('Sample extraction of texts not finished, must be updated to be same as extract_texts()')
-##
-##    w,h = im.size
-##    sw,sh = samplesize
-##    texts = []
-##    
-##    # for each sample
-####        for _ in range(samples):
-####            print _
-####            x,y = uniform(0,w-sw),uniform(0,h-sh)
-##    
-##    for i,q in enumerate(segmentation.sample_quads(im, (sw,sh))):
-##        #print '---'
-##        print '# sample',i,q
-##        x1,y1,x2,y2 = q.bbox()
-##        sample = im.crop((x1,y1,x2,y2))
-##        # upscale
-##        print 'upscaling'
-##        upscale = sample.resize((sample.size[0]*2,sample.size[1]*2), PIL.Image.LANCZOS)
-##        #lab = segmentation.rgb_to_lab(upscale)
-##        #l,a,b = lab.split()
-##        upscale = segmentation.quantize(upscale)
-##        #upscale.show()
-##        for col in textcolors:
-##            # calculate color difference
-##            print 'isolating color'
-##            diff = segmentation.color_difference(upscale, col)
-##
-##            # mask based on color difference threshold
-##            diffmask = diff > threshold
-##
-##            # maybe dilate to get edges?
-####                from PIL import ImageMorph
-####                diffmask = PIL.Image.fromarray(255-diffmask*255).convert('L')
-####                op = ImageMorph.MorphOp(op_name='dilation8')
-####                changes,diffmask = op.apply(diffmask)
-####                diffmask = np.array(diffmask) == 0
-####                # mask to luminance
-####                lmask = np.array(l)
-####                lmask[diffmask] = lmask.max() # cap max luminance to parts that are too different
-##
-##            # OR mask to diff values
-##            diff[diffmask] = threshold
-##            lmask = diff
-##
-##            # normalize
-##            lmax,lmin = lmask.max(),lmask.min()
-##            lmask = (lmask-lmin) / float(lmax-lmin) * 255.0
-##            #print lmask.min(),lmask.max()
-##            lmaskim = PIL.Image.fromarray(lmask.astype(np.uint8))
-##            #lmaskim.show()
-##            
-##            # detect text
-##            print 'running ocr'
-##            data = run_ocr(lmaskim)
-##            
-##            print 'processing text'
-##            for text in data:
-##                
-##                # process text
-##                if float(text['conf']) > textconf and len(text['text']) >= 2:
-##                    
-##                    # clean text
-##                    text['text_clean'] = re.sub('^\\W+|\\W+$', '', text['text'], flags=re.UNICODE) # strips nonalpha chars from start/end
-##
-##                    # ignore nontoponyms
-##                    if not text['text_clean'].replace(' ',''):
-##                        # empty text
-##                        continue
-##                    if not any((ch.isalpha() for ch in text['text_clean'])):
-##                        # does not contain any alpha chars
-##                        continue
-##                    if len([ch for ch in text['text_clean'] if ch.isupper()]) > len(text['text_clean']) / 2:
-##                        # more than half of characters is uppercase
-##                        continue
-##
-##                    # record info
-##                    text['color'] = col
-##
-##                    # downscale coords
-##                    for key in 'left top width height'.split():
-##                        text[key] = int( round(text[key] / 2.0) )
-##
-##                    # ignore tiny text
-##                    if text['width'] <= 4 or text['height'] <= 4:
-##                        continue
-##
-##                    # ignore text along edges (could be cutoff)
-##                    edgebuff = text['height']
-##                    if text['left'] < edgebuff or text['top'] < edgebuff \
-##                       or (text['left']+text['width']) > sw-edgebuff or (text['top']+text['height']) > sh-edgebuff:
-##                        #print 'edge case',text
-##                        #print [edgebuff,edgebuff,sw-edgebuff,sh-edgebuff]
-##                        continue
-##
-##                    # convert sample space to image space
-##                    text['left'] = int(x1 + text['left'])
-##                    text['top'] = int(y1 + text['top'])
-##                    texts.append(text)
-##
-##        print 'texts',len(texts)
-##        if i >= 3:
-##            if len(texts) >= max_texts or i >= max_samples:
-##                break
-##                
-##    return texts
+def sample_texts(im, textcolors, threshold=25, textconf=60, seginfo=None, samplesize=(500,500), min_samples=4, max_samples=8, max_texts=10, cache=None, stats=None):
+    '''Fast alternative to extract_texts(), running OCR only on spatially balanced quad samples of the image,
+    stopping once max_texts toponym candidates have been found spread across the map or after max_samples samples.
+    '''
+    w,h = im.size
+    bbox = map_bbox(im, seginfo)
+    sw,sh = samplesize
+    texts = texttable.TextTable()
+
+    for i,q in enumerate(segmentation.sample_quads(bbox, (sw,sh))):
+        print('# sample',i,q)
 
+        # limit sample to image
+        x1,y1,x2,y2 = q.bbox()
+        box = [max(0,int(x1)), max(0,int(y1)), min(w,int(x2)), min(h,int(y2))]
+        if box[0] >= box[2] or box[1] >= box[3]:
+            continue
+
+        # detect texts in sample, dropping those along the edges (could be cutoff)
+        try:
+            sampletexts = extract_texts(im, textcolors, threshold=threshold, textconf=textconf, bbox=box, cache=cache, stats=stats)
+        except ValueError:
+            # weird error if empty results (i think)
+            sampletexts = texttable.TextTable()
+        sampletexts = filter_edge_texts(sampletexts, box)
+
+        # ignore texts already found in previous overlapping samples
+        new = []
+        for j,text in enumerate(sampletexts):
+            if len(texts):
+                dupl = texts.color_mask(text['color']) & (texts['text_clean'] == text['text_clean']) \
+                       & (texts['left'] <= text['left']+text['width']) & (texts.right >= text['left']) \
+                       & (texts['top'] <= text['top']+text['height']) & (texts.bottom >= text['top'])
+                if dupl.any():
+                    continue
+            new.append(j)
+        texts = texttable.TextTable.concat([texts, sampletexts[new]])
+
+        # check if enough toponym candidates spread across at least 3 of 4 map quadrants
+        candidates = toponyms.filter_toponym_candidates(texts)
+        cx,cy = (bbox[0]+bbox[2])/2.0, (bbox[1]+bbox[3])/2.0
+        quadrants = set(((t['left'] > cx, t['top'] > cy) for t in candidates))
+        print('texts',len(texts),'toponym candidates',len(candidates),'quadrants',len(quadrants))
+        if (i+1) >= min_samples:
+            if (len(candidates) >= max_texts and len(quadrants) >= 3) or (i+1) >= max_samples:
+                break
+                
+    return texts
 
-def extract_texts_parallel(im, textcolors, threshold=25, textconf=60, max_procs=None, tilesize=(500,500)):
+class SharedImage(object):
+    def __init__(self, im):
+        '''Copies an RGB image to shared memory, so that it can be passed to other processes
+        without having to save it to file. When pickled, only the shared memory name is sent
+        and the receiving process gets a zero-copy view of the image pixels.'''
+        from multiprocessing import shared_memory
+        arr = np.asarray(im)
+        self.shape = arr.shape
+        self.shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+        self.owner = True
+        self.arr = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.arr[:] = arr
+
+    def __reduce__(self):
+        return (attach_shared_image, (self.shm.name, self.shape))
+
+    @property
+    def size(self):
+        return self.shape[1], self.shape[0]
+
+    def crop(self, bbox):
+        '''Returns the bbox region as a PIL image, same as PIL.Image.crop()'''
+        x1,y1,x2,y2 = map(int, bbox)
+        return PIL.Image.fromarray(self.arr[y1:y2, x1:x2])
+
+    def close(self):
+        self.arr = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+_attached_images = dict()
+
+def attach_shared_image(name, shape):
+    '''Gets a view of a SharedImage created by another process.
+    Attachments are cached, so each process only attaches once per image.'''
+    if name not in _attached_images:
+        from multiprocessing import shared_memory
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False) # creating process is responsible for cleanup
+        except TypeError:
+            # track option only in py3.13+
+            shm = shared_memory.SharedMemory(name=name)
+        shared = SharedImage.__new__(SharedImage)
+        shared.shape = shape
+        shared.shm = shm
+        shared.owner = False
+        shared.arr = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        _attached_images[name] = shared
+    return _attached_images[name]
+
+def extract_tile_texts(kwargs):
+    '''Runs extract_texts() on a single tile for use with pool.imap_unordered(),
+    returning the tile bbox together with the texts and skip stats.'''
+    stats = dict()
+    try:
+        texts = extract_texts(stats=stats, **kwargs)
+    except ValueError:
+        # weird error if empty results (i think)
+        texts = texttable.TextTable()
+    return kwargs['bbox'], texts, stats
+
+def auto_tilesize(textsizes, overlap_ratio=0.2, minsize=300, maxsize=2000):
+    '''Determines tile size and overlap from the (width,height) of sampled texts.
+    The overlap is set to just contain the largest text plus the 1x fontheight edge buffer
+    used to discard cutoff texts, and tiles are sized so the overlap is about overlap_ratio
+    of the tile size.
+    Returns tilesize and overlap as (width,height) tuples.'''
+    widths,heights = zip(*textsizes)
+    fh = max(heights)
+    overlap = max(widths) + 2*fh, fh + 2*fh
+    tilesize = [min(max(o/float(overlap_ratio), minsize), maxsize) for o in overlap]
+    overlap = [min(o, t/2.0) for o,t in zip(overlap,tilesize)] # always advance at least half a tile
+    tilesize = tuple(map(int, tilesize))
+    overlap = tuple(map(int, overlap))
+    return tilesize, overlap
+
+def extract_texts_parallel(im, textcolors, threshold=25, textconf=60, max_procs=None, tilesize=(500,500), overlap=None, cache=None, min_density=0.0001, stats=None):
+    '''
+    - tilesize is the (width,height) of image tiles to process in parallel.
+    - overlap is the (width,height) in pixels that tiles overlap, defaults to one fifth of the tilesize.
+    '''
     w,h = im.size
     tw,th = map(int, tilesize)
-    texts = []
     tile_overlap = 0.2 # one fifth
+    if overlap:
+        ow,oh = map(int, overlap)
+    else:
+        ow,oh = int(tw*tile_overlap), int(th*tile_overlap)
 
     # div image into bboxes
 ##    boxes = []
@@ -479,24 +731,21 @@ def extract_texts_parallel(im, textcolors, threshold=25, textconf=60, max_procs=
     
     # div image into bboxes
     boxes = []
-    for y1 in range(0, h+1, th-int(th*tile_overlap)):
+    for y1 in range(0, h+1, th-oh):
         y2 = y1+th
         y2 = min(y2, h) # cap at img limits
         #y1 = y2 - th # enforce tile size (extend back in case of small ending sliver)
-        for x1 in range(0, w+1, tw-int(tw*tile_overlap)):
+        for x1 in range(0, w+1, tw-ow):
             x2 = x1+tw
             x2 = min(x2, w) # cap at img limits
             #x1 = x2 - tw # enforce tile size (extend back in case of small ending sliver)
             box = [x1,y1,x2,y2]
             boxes.append(box)
 
-    # save im to temp path, so processes can access
-    import tempfile
-    temppath = tempfile.mktemp() + '.png'
-    im.save(temppath)
+    # put im in shared memory, so processes can access without copying
+    shared = SharedImage(im)
 
     # loop bboxes, starting new subprocess of extract_texts
-    import multiprocessing as mp
     max_procs = max_procs or mp.cpu_count() - 1 # excluding main process
 
     # pool
@@ -530,59 +779,41 @@ def extract_texts_parallel(im, textcolors, threshold=25, textconf=60, max_procs=
     if not isinstance(threshold, list):
         threshold = [threshold for _ in textcolors]
 
-    with mp.Pool(max_procs) as pool:
-        procs = []
-        results = []
-        texts = []
-
-        # initiate processes stepwise
-        for i,box in enumerate(boxes):
-            print('processing img tile', box, i+1, 'of', len(boxes))
-            
-            for textcolor,thresh in zip(textcolors, threshold):
-                print('color',textcolor)
-                
-                # manual procs
-                p = pool.apply_async(extract_texts,
-                                     kwds=dict(im=temppath,
-                                               textcolors=[textcolor],
-                                               threshold=thresh,
-                                               textconf=textconf,
-                                               bbox=box,
-                                               ),
-                                     )
-                procs.append(p)
-                results.append((p,box))
-
-                # wait in line
-                while len(procs) >= max_procs:
-                    for p in procs:
-                        if p.ready():
-                            procs.remove(p)
-
-        # get results of all processes
-        for p,box in results:
-            try:
-                boxtexts = []
+    try:
+        with mp.Pool(max_procs) as pool:
+            tiletexts = dict()
+
+            # one task per tile
+            # (all colors in same proc, so color differences are calculated in one pass)
+            tasks = (dict(im=shared,
+                          textcolors=textcolors,
+                          threshold=threshold,
+                          textconf=textconf,
+                          bbox=box,
+                          cache=cache,
+                          min_density=min_density,
+                          )
+                     for box in boxes)
+
+            # process tile results as they finish, while remaining tiles are still running
+            for i,(box,restexts,tilestats) in enumerate(pool.imap_unordered(extract_tile_texts, tasks)):
+                print('finished img tile', box, i+1, 'of', len(boxes))
+                if stats is not None:
+                    for k,v in tilestats.items():
+                        stats[k] = stats.get(k, 0) + v
                 # ignore any text closer than 1x fontheight away from box edges
-                restexts = p.get(timeout=None)
                 #print 'texts for', box
                 #print 'orig',len(restexts)
-                for text in restexts:
-                    if text['left'] < (box[0] + text['fontheight']):
-                        continue
-                    if text['top'] < (box[1] + text['fontheight']):
-                        continue
-                    if (text['left']+text['width']) > (box[2] - text['fontheight']):
-                        continue
-                    if (text['top']+text['height']) > (box[3] - text['fontheight']):
-                        continue
-                    boxtexts.append(text)
+                boxtexts = filter_edge_texts(restexts, box)
                 #print 'after dropping edge texts',len(boxtexts)
-                texts.extend(boxtexts)
-            except ValueError:
-                # weird error if empty results (i think)
-                pass
+                tiletexts[tuple(box)] = boxtexts
+    finally:
+        # free the shared memory
+        shared.close()
+
+    # collect in tile order, regardless of finishing order
+    texts = texttable.TextTable.concat([tiletexts[tuple(box)] for box in boxes
+                                        if tuple(box) in tiletexts])
 
     # manual
 ##    procs = []
@@ -626,10 +857,13 @@ def extract_texts_parallel(im, textcolors, threshold=25, textconf=60, max_procs=
     return texts
 
 
-def extract_texts(im, textcolors, threshold=25, textconf=60, bbox=None):
+def extract_texts(im, textcolors, threshold=25, textconf=60, bbox=None, cache=None, min_density=0.0001, stats=None):
     '''
     - textcolors is list of colors.
     - threshold can be either single value used for all colors, or iterable of thresholds same length as textcolors.
+    - cache is an optional ocrcache.OCRCache, used to reuse the results of previous runs on identical image tiles.
+    - min_density is the minimum fraction of pixels matching a textcolor for the OCR to be run, so blank areas are skipped.
+    - stats is an optional dict that will be updated with the number of tiles and colors skipped.
     '''
     # load from file if string
     if isinstance(im, basestring):
@@ -641,29 +875,54 @@ def extract_texts(im, textcolors, threshold=25, textconf=60, bbox=None):
     
     # extract from entire image
     w,h = im.size
-    texts = []
-    
-    # upscale
-    print('upscaling')
-    upscale = im.resize((im.size[0]*2,im.size[1]*2), PIL.Image.LANCZOS)
-    #lab = segmentation.rgb_to_lab(upscale)
-    #l,a,b = lab.split()
-    upscale = segmentation.quantize(upscale)
-    #upscale.show()
 
     if isinstance(threshold, (int,float)):
         threshold = [threshold for col in textcolors]
 
     assert len(textcolors) == len(threshold)
+
+    # get any previous results from cache
+    results = [None for col in textcolors]
+    if cache:
+        tilehash = ocrcache.hash_image(im)
+        cachekeys = [cache.make_key(tilehash, col, colthresh, textconf, ocr_version(), 11)
+                     for col,colthresh in zip(textcolors,threshold)]
+        results = [cache.get(key) for key in cachekeys]
+        results = [texttable.TextTable.from_dicts(res) if res is not None else None
+                   for res in results]
+    todo = [i for i,res in enumerate(results) if res is None]
+
+    diffs = []
+    if todo:
+        # upscale
+        print('upscaling')
+        upscale = im.resize((im.size[0]*2,im.size[1]*2), PIL.Image.LANCZOS)
+        #lab = segmentation.rgb_to_lab(upscale)
+        #l,a,b = lab.split()
+        upscale = segmentation.quantize(upscale)
+        #upscale.show()
+
+        # calculate color difference for all colors at once
+        print('isolating colors', [textcolors[i] for i in todo], [threshold[i] for i in todo])
+        diffs = segmentation.color_difference_stack(upscale, [textcolors[i] for i in todo])
     
-    for col,colthresh in zip(textcolors,threshold):
-        # calculate color difference
-        print('isolating color', col, colthresh)
-        diff = segmentation.color_difference(upscale, col)
+    skipped = 0
+    for i,diff in zip(todo,diffs):
+        col,colthresh = textcolors[i],threshold[i]
+        coltexts = []
 
         # mask based on color difference threshold
         diffmask = diff > colthresh
 
+        # skip if too few pixels of this color to contain any text (eg ocean or empty margins)
+        density = 1 - diffmask.mean()
+        if density < min_density:
+            print('skipping color', col, 'too few matching pixels', density)
+            skipped += 1
+            # not cached, since the cache key doesn't include min_density and the check is cheap to redo
+            results[i] = texttable.TextTable()
+            continue
+
         # maybe dilate to get edges?
 ##        from PIL import ImageMorph
 ##        diffmask = PIL.Image.fromarray(255-diffmask*255).convert('L')
@@ -685,8 +944,8 @@ def extract_texts(im, textcolors, threshold=25, textconf=60, bbox=None):
         lmask[diffmask] = 255
         #print lmask.min(),lmask.max()
 
-        lmaskim = PIL.Image.fromarray(lmask.astype(np.uint8))
-        #lmaskim.show()
+        lmask_arr = lmask.astype(np.uint8)
+        #PIL.Image.fromarray(lmask_arr).show()
 
         #imarr = np.array(upscale)
         #imarr[lmask==255] = (255,255,255)
@@ -694,17 +953,16 @@ def extract_texts(im, textcolors, threshold=25, textconf=60, bbox=None):
         
         # detect text
         print('running ocr')
-        data = run_ocr(lmaskim)
+        data = run_ocr(lmask_arr)
         print('processing text')
+
+        # refine ocr of confident texts
+        data = data[data['conf'] > textconf]
+        data = refine_textboxes(lmask, data.to_dicts())
         for text in data:
             
             # process text
             if text['conf'] > textconf:
-
-                # refine ocr
-                #print 'text orig -->', text
-                text = refine_textbox(lmask, text)
-                #print 'text refined -->', text
                 
                 # clean text
                 text['text_clean'] = re.sub('^\\W+|\\W+$', '', text['text'], flags=re.UNICODE) # strips nonalpha chars from start/end
@@ -722,32 +980,56 @@ def extract_texts(im, textcolors, threshold=25, textconf=60, bbox=None):
                     continue
                 
                 # record info
-                text['color'] = col
                 textdiffarr = diff[text['top']:text['top']+text['height'], text['left']:text['left']+text['width']]
                 text['color_match'] = float(textdiffarr[textdiffarr < colthresh].mean()) # average diff of pixels below threshold
-
-                # downscale coords
-                for key in 'left top width height fontheight'.split():
-                    text[key] = int( round(text[key] / 2.0) )
-
-                # ignore tiny text (upscaling results in sometimes detecting ghost text from tiny pixel regions)
-                if text['width'] <= 4 or text['height'] <= 4:
-                    continue
-
-                # offset coords if bbox
-                if bbox:
-                    xoff,yoff = bbox[:2]
-                    text['left'] += xoff
-                    text['top'] += yoff
                 
-                texts.append(text)
+                coltexts.append(text)
+        coltexts = texttable.TextTable.from_dicts(coltexts)
+
+        if len(coltexts):
+            # downscale coords
+            coltexts.scale(0.5)
+
+            # ignore tiny text (upscaling results in sometimes detecting ghost text from tiny pixel regions)
+            coltexts = coltexts[(coltexts['width'] > 4) & (coltexts['height'] > 4)]
+
+        # store in cache
+        results[i] = coltexts
+        if cache:
+            cache.set(cachekeys[i], coltexts.to_dicts())
+
+    # write access times of any cache hits, since pool workers are terminated without a chance to flush
+    if cache:
+        cache.flush()
+
+    # record how many were skipped
+    if stats is not None:
+        stats['tiles'] = stats.get('tiles', 0) + 1
+        stats['tiles_skipped'] = stats.get('tiles_skipped', 0) + int(bool(todo) and skipped == len(todo))
+        stats['colors_skipped'] = stats.get('colors_skipped', 0) + skipped
+
+    # collect texts of all colors
+    for col,coltexts in zip(textcolors,results):
+        coltexts.set_color(col)
+    texts = texttable.TextTable.concat(results)
+            
+    # offset coords if bbox
+    if bbox and len(texts):
+        xoff,yoff = bbox[:2]
+        texts.offset(xoff, yoff)
 
     return texts
 
-def auto_detect_text(im, textcolors=None, colorthresh=25, textconf=60, parallel=False, sample=False, seginfo=None, max_procs=None, max_samples=8, max_texts=10, max_sniff_samples=4+4**2, max_sniff_texts=3):
+def auto_detect_text(im, textcolors=None, colorthresh=25, textconf=60, parallel=False, sample=False, seginfo=None, max_procs=None, max_samples=8, max_texts=10, max_sniff_samples=4+4**2, max_sniff_texts=3, ocr_cache=None, stats=None, tilesize=(500,500)):
+    '''If tilesize is 'auto', the parallel tile size and overlap is determined from the size of the sniffed texts.'''
+    # ocr cache can be given as a path
+    if isinstance(ocr_cache, basestring):
+        ocr_cache = ocrcache.OCRCache(ocr_cache)
+
+    textsizes = []
     if not textcolors:
         print('sniffing text colors')
-        colorgroups = sniff_text_colors(im, seginfo=seginfo, max_samples=max_sniff_samples, max_texts=max_sniff_texts)
+        colorgroups = sniff_text_colors(im, seginfo=seginfo, max_samples=max_sniff_samples, max_texts=max_sniff_texts, textsizes=textsizes, max_workers=max_procs)
 
         # colors as color groupings
         textcolors = list(colorgroups.keys())
@@ -808,11 +1090,19 @@ def auto_detect_text(im, textcolors=None, colorthresh=25, textconf=60, parallel=
 
     # run text detection
     if sample:
-        texts = sample_texts(im, textcolors, threshold=colorthresh, textconf=textconf, max_samples=max_samples, max_texts=max_texts)
+        texts = sample_texts(im, textcolors, threshold=colorthresh, textconf=textconf, seginfo=seginfo, max_samples=max_samples, max_texts=max_texts, cache=ocr_cache, stats=stats)
     elif parallel:
-        texts = extract_texts_parallel(im, textcolors, threshold=colorthresh, textconf=textconf, max_procs=max_procs)
+        # determine tile sizes
+        overlap = None
+        if tilesize == 'auto':
+            if textsizes:
+                tilesize,overlap = auto_tilesize(textsizes)
+                print('auto tilesize', tilesize, 'overlap', overlap)
+            else:
+                tilesize = (500,500) # no samples to base it on
+        texts = extract_texts_parallel(im, textcolors, threshold=colorthresh, textconf=textconf, max_procs=max_procs, tilesize=tilesize, overlap=overlap, cache=ocr_cache, stats=stats)
     else:
-        texts = extract_texts(im, textcolors, threshold=colorthresh, textconf=textconf)
+        texts = extract_texts(im, textcolors, threshold=colorthresh, textconf=textconf, cache=ocr_cache, stats=stats)
     
 ##    for t in texts:
 ##        print t
@@ -1,3 +1,88 @@
+import heapq
+
+
+def sweep_groups(candidates, binvalues, binsize, aligned, start, end):
+    '''Sweeps through candidates already sorted by start position, grouping each with the following
+    aligned candidates as long as each starts within one text height of where the previous one ended.
+    Candidates are bucketed by each of the binvalues functions in bins of binsize,
+    so that only candidates in neighbouring bins need to be checked for alignment
+    (aligned must only be true for values less than binsize apart).
+    Returns a list of groups.'''
+    binsize = binsize if binsize > 0 else 1
+
+    # bin candidates, each bin a linked list in sort order
+    bins = [dict() for _ in binvalues]
+    nexts = [dict() for _ in binvalues]
+    prevs = [dict() for _ in binvalues]
+    for i,r in enumerate(candidates):
+        for f,binvalue in enumerate(binvalues):
+            b = binvalue(r) // binsize
+            tail = bins[f].get(b, (None,None))[1]
+            if tail is None:
+                bins[f][b] = (i,i)
+            else:
+                nexts[f][tail] = i
+                bins[f][b] = (bins[f][b][0], i)
+            prevs[f][i] = tail
+            nexts[f][i] = None
+
+    def remove(i):
+        # unlink from the bins, but keep own next pointer so ongoing iterations can continue past it
+        r = candidates[i]
+        for f,binvalue in enumerate(binvalues):
+            b = binvalue(r) // binsize
+            head,tail = bins[f][b]
+            prv,nxt = prevs[f][i],nexts[f][i]
+            if prv is not None:
+                nexts[f][prv] = nxt
+            if nxt is not None:
+                prevs[f][nxt] = prv
+            head = nxt if head == i else head
+            tail = prv if tail == i else tail
+            bins[f][b] = (head,tail)
+
+    def iterbin(f, b):
+        i = bins[f].get(b, (None,None))[0]
+        while i is not None:
+            yield i
+            i = nexts[f][i]
+
+    done = set()
+    groups = []
+    for i,r in enumerate(candidates):
+        if i in done:
+            continue
+        done.add(i)
+        remove(i)
+
+        # loop remaining candidates in neighbouring bins, in sort order
+        group = [r]
+        right = end(r)
+        neighbours = [iterbin(f, binvalue(r) // binsize + offset)
+                      for f,binvalue in enumerate(binvalues)
+                      for offset in (-1,0,1)]
+        seen = set()
+        for i2 in heapq.merge(*neighbours):
+            if i2 in seen or i2 in done:
+                continue
+            seen.add(i2)
+            r2 = candidates[i2]
+            if (right + r['height']) <= start(r2):
+                # this and all remaining candidates are too far away
+                break
+            if r2 == r: continue
+            # height difference can't be more than x2
+            if (max(r['height'],r2['height']) / float(min(r['height'],r2['height']))) > 2: 
+                continue
+            if aligned(r, r2):
+                # within distance, add to group
+                right = end(r2)
+                done.add(i2)
+                remove(i2) # remove as candidate for others
+                group.append(r2)
+        groups.append(group)
+    return groups
+
 
 
 
@@ -27,74 +112,28 @@ def connect_text(data, ythresh=6, xthresh=6):
         return newdata
     
     # connect texts horizontally
+    # (top or bottom within threshold)
     candidates = sorted(data, key=lambda r: r['left'])
-    newdata = []
-    while candidates:
-        r = candidates.pop(0)
-        # find all whose top and bottom are within threshold
-        totheright = []
-        for r2 in candidates:
-            if r2 == r: continue
-            # height difference can't be more than x2
-            if (max(r['height'],r2['height']) / float(min(r['height'],r2['height']))) > 2: 
-                continue
-            # top or bottom within threshold
-            if (abs(r['top'] - r2['top']) < ythresh) or (abs((r['top']+r['height']) - (r2['top']+r2['height'])) < ythresh): 
-                totheright.append(r2)
-        # group those within height x distance
-        group = [r]
-        right = r['left'] + r['width']
-        while totheright:
-            nxt = totheright.pop(0)
-            if (right + r['height']) > nxt['left']:
-                # within distance, add to group
-                right = nxt['left'] + nxt['width']
-                candidates.pop(candidates.index(nxt)) # remove as candidate for others
-                group.append(nxt)
-            else:
-                # not within distance, break loop
-                break
-        newdata.append(group)
+    newdata = sweep_groups(candidates,
+                           binvalues=[lambda r: r['top'], lambda r: r['top']+r['height']],
+                           binsize=ythresh,
+                           aligned=lambda r,r2: (abs(r['top'] - r2['top']) < ythresh) or (abs((r['top']+r['height']) - (r2['top']+r2['height'])) < ythresh),
+                           start=lambda r: r['left'],
+                           end=lambda r: r['left'] + r['width'])
 
     # merge groups
     newdata = merge_textgroups(newdata)
 
     # do same vertically (center aligned only)
+    # (midpoints within threshold)
     candidates = sorted(newdata, key=lambda r: r['top'])
-    newdata = []
-    while candidates:
-        r = candidates.pop(0)
-        # find all whose midpoints are within threshold
-        below = []
-        for r2 in candidates:
-            if r2 == r: continue
-            # height difference can't be more than x2
-            if (max(r['height'],r2['height']) / float(min(r['height'],r2['height']))) > 2: 
-                continue
-            # midpoints within threshold
-            mid1 = r['left'] + (r['width'] / 2.0)
-            mid2 = r2['left'] + (r2['width'] / 2.0)
-            if abs(mid1 - mid2) < xthresh:
-                below.append(r2)
-        # group those within height y distance
-        group = [r]
-        bottom = r['top'] + r['height']
-        while below:
-            nxt = below.pop(0)
-            #print '---'
-            #print bottom + r['height'], nxt['top']
-            #print r
-            #print nxt
-            if (bottom + r['height']) > nxt['top']:
-                # within distance, add to group
-                bottom = nxt['top'] + nxt['height']
-                candidates.pop(candidates.index(nxt)) # remove as candidate for others
-                group.append(nxt)
-            else:
-                # not within distance, break loop
-                break
-        newdata.append(group)
-
+    mid = lambda r: r['left'] + (r['width'] / 2.0)
+    newdata = sweep_groups(candidates,
+                           binvalues=[mid],
+                           binsize=xthresh,
+                           aligned=lambda r,r2: abs(mid(r) - mid(r2)) < xthresh,
+                           start=lambda r: r['top'],
+                           end=lambda r: r['top'] + r['height'])
     # merge groups
     newdata = merge_textgroups(newdata)
 
@@ -0,0 +1,201 @@
+"""
+Columnar storage of detected texts, as an alternative to one dict per text,
+so that large numbers of texts take up less memory and can be filtered in bulk.
+"""
+
+import numpy as np
+
+try:
+    basestring
+except:
+    basestring = (bytes,str)
+
+# fields stored with a fixed numeric type, any other fields are stored as object columns
+BBOX_FIELDS = ['left', 'top', 'width', 'height', 'fontheight']
+INT_FIELDS = ['level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num'] + BBOX_FIELDS
+FLOAT_FIELDS = ['conf', 'color_match']
+
+
+class TextTable(object):
+    def __init__(self, columns=None, colors=None):
+        '''Stores texts as a dict of equally long numpy arrays, one per text field.
+        Text colors are stored in the 'color' column as indexes into the colors list.
+        Indexing with a field name returns the column, with an integer returns the text as a dict,
+        and with a boolean mask or list of indexes returns a new table with the selected texts.
+        Iterating yields the texts as dicts, same as the lists of text dicts used elsewhere.'''
+        self.columns = columns or dict()
+        self.colors = colors or []
+
+    @classmethod
+    def from_dicts(cls, texts, color=None):
+        '''Creates a table from a list of text dicts. If color is given it is
+        used for all texts, instead of their 'color' field.
+        Fields that are missing from some texts are stored as None.'''
+        texts = list(texts)
+        fields = []
+        for text in texts:
+            for k in text.keys():
+                if k not in fields:
+                    fields.append(k)
+
+        table = cls()
+        if color is not None:
+            table.set_color(color, len(texts))
+            fields = [k for k in fields if k != 'color']
+        for k in fields:
+            table[k] = [text.get(k) for text in texts]
+        return table
+
+    @classmethod
+    def from_geojson(cls, geoj):
+        '''Creates a table from the properties of a geojson FeatureCollection of texts'''
+        return cls.from_dicts((f['properties'] for f in geoj['features']))
+
+    @classmethod
+    def concat(cls, tables):
+        '''Combines a list of tables into one. Fields that are missing from some tables are stored as None.'''
+        tables = [t for t in tables if len(t)]
+        if not tables:
+            return cls()
+        if len(tables) == 1:
+            return tables[0]
+        fields = []
+        for t in tables:
+            fields.extend((k for k in t.fields if k not in fields))
+
+        table = cls()
+        for k in fields:
+            if k == 'color':
+                continue
+            if all((k in t.columns and t.columns[k].dtype != object for t in tables)):
+                table.columns[k] = np.concatenate([t.columns[k] for t in tables])
+            else:
+                table[k] = [v for t in tables for v in (t.column_values(k) if k in t.columns else [None]*len(t))]
+        if 'color' in fields:
+            table['color'] = [v for t in tables for v in (t.column_values('color') if 'color' in t.columns else [None]*len(t))]
+        return table
+
+    def to_dicts(self):
+        '''Returns the texts as a list of dicts, leaving out any None values'''
+        fields = self.fields
+        values = [self.column_values(k) for k in fields]
+        return [dict(((k,v) for k,v in zip(fields,row) if v is not None))
+                for row in zip(*values)]
+
+    def to_geojson(self):
+        '''Returns the texts as a geojson FeatureCollection of text bbox polygons'''
+        geoj = {'type': 'FeatureCollection', 'features': []}
+        for r in self.to_dicts():
+            x1,y1,x2,y2 = r['left'], r['top'], r['left']+r['width'], r['top']+r['height']
+            box = [(x1,y1),(x2,y1),(x2,y2),(x1,y2),(x1,y1)]
+            feat = {'type':'Feature', 'geometry':{'type':'Polygon', 'coordinates':[box]}, 'properties':r}
+            geoj['features'].append(feat)
+        return geoj
+
+    @property
+    def fields(self):
+        return list(self.columns.keys())
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self.columns and not len(self):
+                return np.array([]) # empty tables have no known fields
+            return self.columns[key]
+        elif isinstance(key, (int,np.integer)):
+            text = dict()
+            for k,v in self.columns.items():
+                val = self.colors[v[key]] if k == 'color' else v[key]
+                val = val.item() if isinstance(val, np.generic) else val
+                if val is not None:
+                    text[k] = val
+            return text
+        else:
+            return self.subset(key)
+
+    def __setitem__(self, key, values):
+        if key == 'color':
+            # store as indexes into the colors list
+            colorindex = dict(((col,i) for i,col in enumerate(self.colors)))
+            idxs = []
+            for col in values:
+                col = tuple(col) if col is not None else col
+                if col not in colorindex:
+                    colorindex[col] = len(self.colors)
+                    self.colors.append(col)
+                idxs.append(colorindex[col])
+            values = np.array(idxs, dtype=np.int16)
+        elif isinstance(values, np.ndarray):
+            pass
+        elif key in INT_FIELDS and not any((v is None for v in values)):
+            values = np.array(values, dtype=np.int32)
+        elif key in FLOAT_FIELDS and not any((v is None for v in values)):
+            values = np.array(values, dtype=np.float64)
+        else:
+            arr = np.empty(len(values), dtype=object)
+            arr[:] = values
+            values = arr
+        if self.columns and len(values) != len(self):
+            raise ValueError('Column {} has length {}, but table has length {}'.format(key, len(values), len(self)))
+        self.columns[key] = values
+
+    def set_color(self, color, length=None):
+        '''Sets the same color for all texts'''
+        length = len(self) if length is None else length
+        self.colors = [tuple(color)]
+        self.columns['color'] = np.zeros(length, dtype=np.int16)
+
+    def column_values(self, key):
+        '''Returns the values of a column as a list of python objects'''
+        if key == 'color':
+            return [self.colors[i] for i in self.columns['color']]
+        return self.columns[key].tolist()
+
+    def color_mask(self, color):
+        '''Returns a boolean mask of texts with the given color'''
+        color = tuple(color)
+        if color not in self.colors:
+            return np.zeros(len(self), dtype=bool)
+        return self.columns['color'] == self.colors.index(color)
+
+    def used_colors(self):
+        '''Returns the set of colors that are used by any text'''
+        if not len(self):
+            return set()
+        return set((self.colors[i] for i in np.unique(self.columns['color'])))
+
+    def subset(self, key):
+        '''Returns a new table with only the texts selected by a boolean mask or list of indexes'''
+        if not isinstance(key, slice):
+            key = np.asarray(key)
+            if key.dtype != bool:
+                key = key.astype(np.intp)
+        columns = dict(((k,v[key]) for k,v in self.columns.items()))
+        return TextTable(columns, list(self.colors))
+
+    @property
+    def right(self):
+        return self['left'] + self['width']
+
+    @property
+    def bottom(self):
+        return self['top'] + self['height']
+
+    def offset(self, xoff, yoff):
+        '''Moves all text bboxes by xoff,yoff in place'''
+        self.columns['left'] += xoff
+        self.columns['top'] += yoff
+
+    def scale(self, factor):
+        '''Scales all bbox and fontheight values by factor in place, rounded to the nearest integer'''
+        for k in BBOX_FIELDS:
+            if k in self.columns:
+                self.columns[k] = np.round(self.columns[k] * factor).astype(np.int32)
+
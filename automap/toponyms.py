@@ -1,5 +1,6 @@
 
 from . import segmentation
+from . import texttable
 
 import numpy as np
 
@@ -11,7 +12,26 @@ import shapely
 
 
 
-def filter_toponym_candidates(data, seginfo=None):
+def intersects_boxes(shp, boxes):
+    '''Tests which of an (n,4) array of [xmin,ymin,xmax,ymax] bboxes intersect a shapely geometry.
+    The geometry is prepared once, and with shapely 2 all boxes are tested at once.
+    Returns a boolean array.'''
+    if not len(boxes):
+        return np.zeros(0, dtype=bool)
+    if hasattr(shapely, 'intersects'):
+        # vectorized shapely 2
+        shapely.prepare(shp)
+        return shapely.intersects(shp, shapely.box(boxes[:,0], boxes[:,1], boxes[:,2], boxes[:,3]))
+    else:
+        from shapely.prepared import prep
+        prepared = prep(shp)
+        return np.array([prepared.intersects(shapely.geometry.box(*bbox)) for bbox in boxes], dtype=bool)
+
+def filter_toponym_candidates(data, seginfo=None, stats=None):
+    '''Returns the text dicts that resemble toponyms and are located in relevant parts of the image.
+    - data is a texttable.TextTable or list of text dicts.
+    - stats is an optional dict that will be updated with the number of texts dropped by each rule.
+    '''
     if seginfo:
         # inclusion region
         incl_shp = None
@@ -36,72 +56,89 @@ def filter_toponym_candidates(data, seginfo=None):
             elif len(boxshps) == 1:
                 excl_shp = boxshps[0]
     
-    topotexts = []
-    for text in data:
-        # only texts that resemble a toponym
-        alphachars = text['text_alphas']
+    if not isinstance(data, texttable.TextTable):
+        data = texttable.TextTable.from_dicts(data)
+    if stats is None:
+        stats = dict()
+    for rule in 'alphas numeric lowercase uppercase outside_map inside_box'.split():
+        stats.setdefault('dropped_'+rule, 0)
+
+    # only texts that resemble a toponym
+    keep = np.zeros(len(data), dtype=bool)
+    for i,(text_clean,alphachars) in enumerate(zip(data['text_clean'], data['text_alphas'])):
         if len(alphachars) < 2:
             # toponyms must contain at least 2 alpha chars
+            stats['dropped_alphas'] += 1
             continue
-        if any((ch.isnumeric() for ch in text['text_clean'])):
+        if any((ch.isnumeric() for ch in text_clean)):
             # cannot contain any numbers
+            stats['dropped_numeric'] += 1
             continue
-        if not text['text_clean'][0].isupper():
+        if not text_clean[0].isupper():
             # first char must be uppercase
+            stats['dropped_lowercase'] += 1
             continue
         if len([ch for ch in alphachars if ch.isupper()]) > (len(alphachars) / 2.0):
             # are not all uppercase
             # upper = more than half of characters is uppercase (to allow for minor ocr upper/lower errors)
+            stats['dropped_uppercase'] += 1
             continue
-
-        # only texts in relevant parts of the image
-        if seginfo and (incl_shp or excl_shp):
-            bbox = [text['left'], text['top'], text['left']+text['width'], text['top']+text['height']]
-            text_shp = shapely.geometry.box(*bbox)
-            # must be in inclusion region
-            if incl_shp and not text_shp.intersects(incl_shp):
-                continue
-            # must not be in exclusion region
-            if excl_shp and text_shp.intersects(excl_shp):
-                continue
+        keep[i] = True
+
+    # only texts in relevant parts of the image
+    if seginfo and (incl_shp or excl_shp):
+        idxs = np.flatnonzero(keep)
+        candidates = data[idxs]
+        boxes = np.column_stack([candidates['left'], candidates['top'], candidates.right, candidates.bottom])
+        # must be in inclusion region
+        if incl_shp:
+            inside = intersects_boxes(incl_shp, boxes)
+            stats['dropped_outside_map'] += int((~inside).sum())
+            idxs,boxes = idxs[inside],boxes[inside]
+        # must not be in exclusion region
+        if excl_shp:
+            inbox = intersects_boxes(excl_shp, boxes)
+            stats['dropped_inside_box'] += int(inbox.sum())
+            idxs,boxes = idxs[~inbox],boxes[~inbox]
+        keep[:] = False
+        keep[idxs] = True
         
-        topotexts.append(text)
+    topotexts = data[keep].to_dicts()
     return topotexts
 
 
-def detect_toponym_anchors(im, texts, toponyms, debug=False):
+def detect_toponym_anchors(im, texts, toponyms, debug=False, max_workers=None):
     '''Detect anchor points from image, set each text's anchor point with the 'anchor' key.
-    - im is the original image.
+    - im is the original image, or the same image already quantized with segmentation.quantize().
     - texts is list of tesseract text dict results (used to exclude areas when looking for anchor points).
     - toponyms is those text dicts considered to be possible toponyms.
+    - max_workers is the number of threads used to process toponyms in parallel, defaults to the number of cpus.
+    The anchor mask is only calculated within the buffered window around each toponym,
+    instead of for the entire image. Returns the toponyms in the same order as given.
     '''
-    # first threshold img to black pixels only
+    # quantize, so the color difference of each pixel can be looked up from the palette colors
+    quant = im if im.mode == 'P' else segmentation.quantize(im)
+    idx,palette = segmentation.palette_indices(quant)
+    imh,imw = idx.shape
+
+    # threshold palette colors to black pixels only
     # (anchors are usually thick and almost always black, so not as affected by color blending as text)
-    diff = segmentation.color_difference(segmentation.quantize(im), (0,0,0))
-    diff[diff > 25] = 255
-    diff[diff <= 25] = 0
-    anchor_im = PIL.Image.fromarray(diff)
+    diff = segmentation.palette_difference(palette, (0,0,0))
+    lut = np.where(diff > 25, 255, 0).astype(np.uint8)
 
     # OR get color changes/edges
     #changes = segmentation.color_changes(im)
     #changes[changes > 10] = 255
     #anchor_im = PIL.Image.fromarray(changes)
 
-    # blank out all text regions
-    im_arr = np.array(anchor_im).astype(np.uint8)
-    im_arr_orig = im_arr.copy()
-    for r in texts:
-        x1,y1,w,h = [int(r[k]) for k in 'left top width height'.split()]
-        x2 = x1+w
-        y2 = y1+h
-        fh = int(r['fontheight'])
-
-        # do not look inside text region itself (NOTE: is sometimes too big and covers the point too)
-        im_arr[y1:y2, x1:x2] = 255
+    # text regions to blank out
+    textboxes = np.array([[int(r[k]) for k in 'left top width height'.split()]
+                          for r in texts], dtype=int).reshape((-1,4))
+    tx1,ty1 = textboxes[:,0],textboxes[:,1]
+    tx2,ty2 = tx1+textboxes[:,2],ty1+textboxes[:,3]
 
-    # loop texts and process each individually
-    newdata = []
-    for r in toponyms:
+    # process each text individually
+    def detect_anchor(r):
         x1,y1,w,h = [int(r[k]) for k in 'left top width height'.split()]
         x2 = x1+w
         y2 = y1+h
@@ -116,8 +153,14 @@ def detect_toponym_anchors(im, texts, toponyms, debug=False):
         buff = int(fh * 1)
         edge = int(fh * 1)
         top,bottom,left,right = y1-buff-edge, y2+buff+edge, x1-buff-edge, x2+buff+edge
-        top,bottom,left,right = max(top, 0), min(bottom, im_arr.shape[0]), max(left, 0), min(right, im_arr.shape[1])
-        buff_im_arr = im_arr[top:bottom, left:right] 
+        top,bottom,left,right = max(top, 0), min(bottom, imh), max(left, 0), min(right, imw)
+        buff_im_arr = lut[idx[top:bottom, left:right]]
+
+        # blank out all text regions within the window
+        # do not look inside text region itself (NOTE: is sometimes too big and covers the point too)
+        inside = (tx1 < right) & (tx2 > left) & (ty1 < bottom) & (ty2 > top)
+        for bx1,by1,bx2,by2 in zip(tx1[inside],ty1[inside],tx2[inside],ty2[inside]):
+            buff_im_arr[max(by1-top, 0):by2-top, max(bx1-left, 0):bx2-left] = 255
         
         # look for distance anchor
         newr = detect_text_anchor_distance(buff_im_arr, r, debug=debug)
@@ -126,8 +169,17 @@ def detect_toponym_anchors(im, texts, toponyms, debug=False):
         if 'anchor' not in newr:
             newr = detect_text_anchor_contour(buff_im_arr, r, debug=debug)
 
-        # add
-        newdata.append(newr)
+        return newr
+
+    # loop texts, in parallel threads unless debugging
+    # (opencv releases the gil so threads are sufficient)
+    if debug or max_workers == 1:
+        newdata = [detect_anchor(r) for r in toponyms]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        import multiprocessing as mp
+        with ThreadPoolExecutor(max_workers or mp.cpu_count()) as executor:
+            newdata = list(executor.map(detect_anchor, toponyms))
 
     return newdata
         
@@ -3,6 +3,8 @@
 
 import itertools
 
+import numpy as np
+
 from . import patternmatch
 from . import geocode
 from . import transforms
@@ -36,7 +38,7 @@ def triangulate(coder, names, positions, matchcandidates=None, flipy=False):
         for name in names:
             match = list(coder.geocode(name))
             if match:
-                matchcandidates.append(match)
+                matchcandidates.append(geocode.Candidates.from_features(name, match))
 
     if len(matchcandidates) < 3:
         return []
@@ -46,13 +48,15 @@ def triangulate(coder, names, positions, matchcandidates=None, flipy=False):
 
     # find unique combinations of all possible candidates
     #print 'combining'
-    combis = list(itertools.product(*matchcandidates))
+    candnames = [list(c.names) for c in matchcandidates]
+    candcoords = [c.coords for c in matchcandidates]
+    combis = list(itertools.product(*[range(len(c)) for c in matchcandidates]))
     combipatterns = []
     for combi in combis:
         #print '--->', combi
         # make into polygon feature
-        combinames = [f['properties']['name'] for f in combi]
-        combipositions = [f['geometry']['coordinates'] for f in combi]
+        combinames = [n[i] for n,i in zip(candnames,combi)]
+        combipositions = [c[i] for c,i in zip(candcoords,combi)]
         combipattern = {'type': 'Feature',
                        'properties': {'combination': combinames,
                                       },
@@ -94,17 +98,18 @@ def triangulate_add(coder, origs, matches, add, addcandidates=None):
         match = list(coder.geocode(addname))
         if not match:
             return False
+        match = geocode.Candidates.from_features(addname, match)
             
     #print len(match)
 
     # find unique combinations of all possible candidates
     #print 'combining'
     combipatterns = []
-    for m in match:
+    for mname,mpos in zip(match.names, match.coords):
         #print '--->', combi
         # make into polygon feature
-        combinames = list(matchnames) + [m['properties']['name']]
-        combipositions = list(matchpositions) + [m['geometry']['coordinates']]
+        combinames = list(matchnames) + [mname]
+        combipositions = list(matchpositions) + [mpos]
         combipattern = {'type': 'Feature',
                        'properties': {'combination': combinames,
                                       },
@@ -123,35 +128,47 @@ def triangulate_add(coder, origs, matches, add, addcandidates=None):
     matches = patternmatch.find_best_matches(findpattern, combipatterns)
     return matches
 
-def find_matchsets(test, thresh=0.25, minpoints=8, mintrials=8, maxiter=10000, maxcandidates=None, n_combi=3, db=None, source='best', debug=False):
+def find_matchsets(test, thresh=0.25, minpoints=8, mintrials=8, maxiter=10000, maxcandidates=None, n_combi=3, db=None, source='best', name_index=False, geocode_cache=None, max_distance=0, bbox=None, debug=False):
+    '''If name_index is True, all names are geocoded at once using the in-memory gazetteer name index.
+    Geocode results are cached for the rest of the process, and if geocode_cache is a filepath
+    the cache is also saved there for later runs.
+    If max_distance is set, names that can't be geocoded are looked up allowing for up to max_distance
+    character errors.
+    If bbox [xmin,ymin,xmax,ymax] is given, eg the known region of a regional map series, only candidate
+    locations within it are considered.'''
     # filter to those that can be geocoded
     print('geocode and filter')
-    coder = geocode.OptimizedCoder(db)
+    coder = geocode.get_cached_coder(db, name_index=name_index, cache_path=geocode_cache, max_distance=max_distance)
+
+    # geocode all names at once
+    try:
+        geocoded = coder.geocode_many([nxtname for nxtname,nxtpos in test], maxcandidates, max_distance=max_distance, bbox=bbox, compact=True)
+    except Exception as err:
+        print('EXCEPTION:', err)
+        geocoded = dict()
+    print('geocode cache hits',coder.hits,'misses',coder.misses)
+    if geocode_cache:
+        coder.save()
     
     testres = []
     for nxtname,nxtpos in test:
         print('geocoding',nxtname)
         try:
-            res = list(coder.geocode(nxtname, maxcandidates))
+            # copy results, since same name can occur more than once
+            res = geocoded[nxtname].copy() if nxtname in geocoded else None
             if res:
                 if source == 'avg':
-                    import math
-                    resnew = []
-                    for r in res:
-                        mayberes = [r2 for r2 in res if r != r2 and r['properties']['data'] != r2['properties']['data']]
-                        x,y = r['geometry']['coordinates']
-                        mayberes = [r2 for r2 in mayberes if math.hypot(abs(r2['geometry']['coordinates'][0]-x), abs(r2['geometry']['coordinates'][1]-y)) < 0.5]
-                        if mayberes:
-                            xs,ys = zip(*[r2['geometry']['coordinates'] for r2 in mayberes])
-                            xm = sum(xs)/float(len(xs))
-                            ym = sum(ys)/float(len(ys))
-                            r['geometry'] = dict(type='Point', coordinates=(xm,ym))
-                        resnew.append(r)
-                    res = resnew
+                    # move each location to the average of nearby locations from other sources,
+                    # in place so later locations see the already averaged ones
+                    lon,lat = res.lon,res.lat
+                    for i in range(len(res)):
+                        near = (res.data != res.data[i]) & (np.hypot(lon-lon[i], lat-lat[i]) < 0.5)
+                        if near.any():
+                            lon[i],lat[i] = lon[near].mean(),lat[near].mean()
                 elif source == 'best':
                     pass # just keep all the results and choose best matching ones
                 else:
-                    res = [r for r in res if r['properties']['data']==source]
+                    res = res.subset(res.source_mask(source))
                 if res:
                     testres.append((nxtname,nxtpos,res))
                 #time.sleep(0.1)
@@ -0,0 +1,163 @@
+
+# checks that the sweep based textgroup.connect_text gives identical groups
+# to the original brute force implementation
+# usage: python testconnecttext.py [texts.geojson ...]
+# where the optional geojson files are recorded text outputs, eg from the automap debug output
+# otherwise uses simulated ocr word boxes
+
+import automap as mapfit
+from automap.textgroup import connect_text
+
+import sys
+import json
+import random
+import time
+
+
+def connect_text_bruteforce(data, ythresh=6, xthresh=6):
+    # the original quadratic implementation, kept here as reference
+
+    def merge_textgroups(newdata):
+        for i in range(len(newdata)):
+            group = newdata[i]
+            dct = {'text': ' '.join([r['text'] for r in group]),
+                   'text_clean': ' '.join([r['text_clean'] for r in group]),
+                   'text_alphas': ''.join([r['text_alphas'] for r in group]),
+                   'conf': sum([r['conf'] for r in group]) / float(len(group)),
+                   'left': min([r['left'] for r in group]),
+                   'top': min([r['top'] for r in group]),
+                   'fontheight': max([r['fontheight'] for r in group]),
+                   'color': group[0]['color'],
+                   'color_match': sum([r['color_match'] for r in group]) / float(len(group)),
+                   }
+            dct['width'] = max([r['left']+r['width'] for r in group]) - dct['left']
+            dct['height'] = max([r['top']+r['height'] for r in group]) - dct['top']
+            newdata[i] = dct
+        return newdata
+
+    # connect texts horizontally
+    candidates = sorted(data, key=lambda r: r['left'])
+    newdata = []
+    while candidates:
+        r = candidates.pop(0)
+        totheright = []
+        for r2 in candidates:
+            if r2 == r: continue
+            if (max(r['height'],r2['height']) / float(min(r['height'],r2['height']))) > 2:
+                continue
+            if (abs(r['top'] - r2['top']) < ythresh) or (abs((r['top']+r['height']) - (r2['top']+r2['height'])) < ythresh):
+                totheright.append(r2)
+        group = [r]
+        right = r['left'] + r['width']
+        while totheright:
+            nxt = totheright.pop(0)
+            if (right + r['height']) > nxt['left']:
+                right = nxt['left'] + nxt['width']
+                candidates.pop(candidates.index(nxt))
+                group.append(nxt)
+            else:
+                break
+        newdata.append(group)
+
+    newdata = merge_textgroups(newdata)
+
+    # do same vertically (center aligned only)
+    candidates = sorted(newdata, key=lambda r: r['top'])
+    newdata = []
+    while candidates:
+        r = candidates.pop(0)
+        below = []
+        for r2 in candidates:
+            if r2 == r: continue
+            if (max(r['height'],r2['height']) / float(min(r['height'],r2['height']))) > 2:
+                continue
+            mid1 = r['left'] + (r['width'] / 2.0)
+            mid2 = r2['left'] + (r2['width'] / 2.0)
+            if abs(mid1 - mid2) < xthresh:
+                below.append(r2)
+        group = [r]
+        bottom = r['top'] + r['height']
+        while below:
+            nxt = below.pop(0)
+            if (bottom + r['height']) > nxt['top']:
+                bottom = nxt['top'] + nxt['height']
+                candidates.pop(candidates.index(nxt))
+                group.append(nxt)
+            else:
+                break
+        newdata.append(group)
+
+    newdata = merge_textgroups(newdata)
+
+    return newdata
+
+
+def make_text(text, left, top, width, height):
+    return {'text':text, 'text_clean':text, 'text_alphas':text,
+            'conf':random.randint(60,96), 'left':left, 'top':top,
+            'width':width, 'height':height, 'fontheight':height,
+            'color':(0,0,0), 'color_match':random.uniform(0,25)}
+
+
+def simulate_texts(n, size=(4000,3000), seed=None):
+    # ocr-like word boxes, laid out as multi word labels and stacked labels with some jitter,
+    # plus scattered noise boxes
+    random.seed(seed)
+    texts = []
+    while len(texts) < n:
+        fontheight = random.choice([8,10,12,12,14,18,24])
+        x,y = random.randint(0,size[0]), random.randint(0,size[1])
+        for line in range(random.choice([1,1,1,2,3])):
+            words = random.choice([1,1,2,2,3])
+            linewidth = 0
+            lineboxes = []
+            for word in range(words):
+                w = random.randint(2,10) * fontheight // 2
+                h = fontheight + random.randint(-2,2)
+                lineboxes.append((linewidth, random.randint(-2,2), w, h))
+                linewidth += w + random.randint(fontheight//4, fontheight)
+            left = x - linewidth // 2 + random.randint(-3,3)
+            top = y + line * int(fontheight * 1.3)
+            for dx,dy,w,h in lineboxes:
+                texts.append(make_text('word', left+dx, top+dy, w, h))
+        if random.random() < 0.2:
+            texts.append(make_text('x', random.randint(0,size[0]), random.randint(0,size[1]), random.randint(2,20), random.randint(3,30)))
+    return texts[:n]
+
+
+def load_texts(path):
+    texts = []
+    for f in json.load(open(path))['features']:
+        props = f['properties']
+        r = make_text(props['text'], props['left'], props['top'], props['width'], props['height'])
+        for k in r.keys():
+            if k in props: r[k] = props[k]
+        texts.append(r)
+    return texts
+
+
+def check(texts, **kwargs):
+    t = time.time()
+    expected = connect_text_bruteforce([dict(r) for r in texts], **kwargs)
+    t_old = time.time() - t
+    t = time.time()
+    result = connect_text([dict(r) for r in texts], **kwargs)
+    t_new = time.time() - t
+    print('{} texts -> {} groups, bruteforce {:.3f}s, sweep {:.3f}s'.format(len(texts), len(result), t_old, t_new))
+    assert result == expected
+
+
+def test_connect_text():
+    for n in (0, 1, 10, 100, 1000, 3000):
+        check(simulate_texts(n, seed=n))
+    check(simulate_texts(1000, seed=1), ythresh=12, xthresh=20)
+    check(simulate_texts(1000, seed=2), ythresh=1, xthresh=1)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        for path in sys.argv[1:]:
+            check(load_texts(path))
+    else:
+        test_connect_text()
+
@@ -0,0 +1,80 @@
+
+# checks that the grid based textdetect.deduplicate_texts drops the same texts
+# as the original brute force loop over all color pairs in main.text_detection
+# usage: python testdeduplicate.py
+
+from automap.textdetect import deduplicate_texts
+from automap.texttable import TextTable
+
+import itertools
+import math
+import random
+import time
+
+
+def deduplicate_texts_bruteforce(texts, colors):
+    # the original quadratic implementation, kept here as reference (duplicate printouts left out)
+    # for every combination of text colors
+    for col,col2 in itertools.combinations(colors, 2):
+        coltexts = [r for r in texts if r['color'] == col]
+        coltexts2 = [r for r in texts if r['color'] == col2]
+        # we got two different colored groups of text
+        for r in coltexts:
+            for r2 in coltexts2:
+                # find texts that overlap
+                if not (r['left'] > (r2['left']+r2['width']) \
+                        or (r['left']+r['width']) < r2['left'] \
+                        or r['top'] > (r2['top']+r2['height']) \
+                        or (r['top']+r['height']) < r2['top'] \
+                        ):
+                    # drop the one with the poorest color match
+                    if r2['color_match'] > r['color_match'] and not math.isnan(r2['color_match']):
+                        r2['drop'] = True
+                    else:
+                        r['drop'] = True
+    texts = [r for r in texts if not r.get('drop')]
+    return texts
+
+
+def simulate_texts(n, colors, size=(4000,3000), seed=None):
+    # ocr word boxes of several colors, where some are near copies of another text in a different color
+    # as happens when the same text is detected for similar text colors, with some tied and nan color matches
+    random.seed(seed)
+    texts = []
+    while len(texts) < n:
+        fh = random.choice([8,10,12,14,18,24])
+        left,top = random.randint(0,size[0]), random.randint(0,size[1])
+        width = random.randint(2,10) * fh // 2
+        for col in random.sample(colors, random.choice([1,1,2,3])):
+            match = random.choice([random.uniform(0,25), 10.0, float('nan')])
+            texts.append({'text':'word', 'text_clean':'word', 'color':col, 'color_match':match,
+                          'left':left+random.randint(-3,3), 'top':top+random.randint(-3,3),
+                          'width':width+random.randint(-3,3), 'height':fh, 'fontheight':fh})
+    for i,r in enumerate(texts):
+        r['id'] = i
+    return texts[:n]
+
+
+def check(texts, colors):
+    t = time.time()
+    expected = deduplicate_texts_bruteforce([dict(r) for r in texts], colors)
+    t_old = time.time() - t
+    t = time.time()
+    result = deduplicate_texts(TextTable.from_dicts(texts), colors)
+    t_new = time.time() - t
+    print('{} texts -> {} kept, bruteforce {:.3f}s, grid {:.3f}s'.format(len(texts), len(result), t_old, t_new))
+    assert [r['id'] for r in result] == [r['id'] for r in expected]
+
+
+def test_deduplicate_texts():
+    colors = [(0,0,0), (200,30,30), (30,30,200), (90,90,90)]
+    for n in (1, 10, 100, 1500, 3000):
+        check(simulate_texts(n, colors, seed=n), colors)
+    # different color order, which decides ties
+    check(simulate_texts(1500, colors, seed=1), colors[::-1])
+    # crowded
+    check(simulate_texts(1500, colors, size=(500,500), seed=2), colors)
+
+
+if __name__ == '__main__':
+    test_deduplicate_texts()
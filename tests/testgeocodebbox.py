@@ -0,0 +1,56 @@
+
+# checks that geocoding limited to a bbox gives the same results as filtering afterwards,
+# and that it isn't much slower than geocoding without a bbox, even for bboxes covering the whole gazetteer
+# usage: python testgeocodebbox.py [n_locations]
+
+from automap import geocode, gazetteer
+
+import os
+import sys
+import random
+import time
+import tempfile
+
+
+def simulate_gazetteer(path, n, seed=None):
+    # one source of point locations, each name shared by 3 locations
+    random.seed(seed)
+    rows = ((i, random.uniform(-180,180), random.uniform(-90,90), 'P', None, ['name%d' % (i % (n//3))])
+            for i in range(n))
+    gazetteer.build_gazetteer(path, [('sim', rows)])
+
+
+def within(r, bbox):
+    x,y = r['geometry']['coordinates']
+    return bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]
+
+
+def check(coder, names, bbox):
+    t = time.time()
+    expected = coder.geocode_many(names)
+    t_none = time.time() - t
+    t = time.time()
+    result = coder.geocode_many(names, bbox=bbox)
+    t_bbox = time.time() - t
+    print('{} names, no bbox {:.3f}s, bbox {} {:.3f}s'.format(len(names), t_none, bbox, t_bbox))
+    for name in names:
+        assert result[name] == [r for r in expected[name] if within(r, bbox)]
+    assert t_bbox < max(t_none * 5, 0.5)
+
+
+def test_geocode_bbox(n=300000):
+    path = os.path.join(tempfile.mkdtemp(), 'gazetteer.db')
+    simulate_gazetteer(path, n, seed=n)
+    names = ['name%d' % i for i in range(1000)]
+    for name_index in (False, True):
+        coder = geocode.OptimizedCoder(path, name_index=name_index)
+        assert coder.spatial_index
+        for bbox in ((-180,-90,180,90), (-20,-10,40,30), (0,0,1,1)):
+            check(coder, names, bbox)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        test_geocode_bbox(int(sys.argv[1]))
+    else:
+        test_geocode_bbox()
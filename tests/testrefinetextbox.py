@@ -0,0 +1,162 @@
+
+# checks that the vectorized textdetect.refine_textbox and batched refine_textboxes give identical
+# refined boxes to the original loop based implementation
+# usage: python testrefinetextbox.py
+
+from automap.textdetect import refine_textbox, refine_textboxes
+
+import random
+import warnings
+
+import numpy as np
+
+
+def refine_textbox_loops(im_arr, textdata):
+    # the original loop based implementation, kept here as reference (debug views left out)
+
+    # textbox histograms is not very accurate for short text strings, skip
+    if len(textdata['text']) < 3:
+        return textdata
+
+    # crop img to box
+    x,y = textdata['left'],textdata['top']
+    w,h = textdata['width'],textdata['height']
+    im_box = im_arr[y:y+h, x:x+w]
+    if im_box.shape[1] <= 4 or im_box.shape[0] <= 4:
+        return textdata # too small
+
+    # calc y hist
+    horiz = []
+    ys = list(range(y, y+h))
+    for boxy in range(im_box.shape[0]):
+        summ = (im_box[boxy,:] < 255).sum()
+        horiz.append(summ)
+
+    # define upper and lower font core as first and last time hist reaches more than 90% of above-avg mean
+    histmean = np.mean(horiz)
+    histmeanpos = np.mean([v for v in horiz if v > histmean])
+    histthresh = histmeanpos * 0.9
+    ystart = textdata['top']
+    for y,ycount in zip(ys,horiz):
+        if ycount >= histthresh:
+            ystart = y
+            break
+    yend = textdata['top'] + textdata['height']
+    for y,ycount in reversed(list(zip(ys,horiz))):
+        if ycount >= histthresh:
+            yend = y
+            break
+
+    # calc x hist
+    vertic = []
+    xs = list(range(x, x+w))
+    for x in range(im_box.shape[1]):
+        summ = (im_box[:,x] < 255).sum()
+        vertic.append(summ)
+
+    # define left and right text boundary as first and last time hist reaches more than 90% of above-avg mean
+    histmean = np.mean(vertic)
+    histmeanpos = np.mean([v for v in vertic if v > histmean])
+    histthresh = histmeanpos * 0.9
+    xstart = textdata['left']
+    for x,xcount in zip(xs,vertic):
+        if xcount >= histthresh:
+            xstart = x
+            break
+    xend = textdata['left'] + textdata['width']
+    for x,xcount in reversed(list(zip(xs,vertic))):
+        if xcount >= histthresh:
+            xend = x
+            break
+
+    # calc bbox change as percent of font height
+    x1change = (xstart-textdata['left']) / float(textdata['height'])
+    x2change = (xend-(textdata['left']+textdata['width'])) / float(textdata['height'])
+    y1change = (ystart-textdata['top']) / float(textdata['height'])
+    y2change = (yend-(textdata['top']+textdata['height'])) / float(textdata['height'])
+
+    # only change boundaries that change beyond threshold
+    xchangethresh = 1.5 # left right moved by >1.5x font height
+    ychangethresh = 0.5 # top bottom moved by >50% font height
+    h = yend-ystart
+    if x1change > xchangethresh:
+        xstart -= int(round(h)) # expand the left by 1x the font core
+    else:
+        xstart = textdata['left'] # set back to original
+        
+    if x2change < -xchangethresh:
+        xend += int(round(h)) # expand the right edge by 1x the font core
+    else:
+        xend = textdata['left']+textdata['width'] # set back to original
+        
+    if y1change > ychangethresh:
+        ystart -= int(round(h/2.0)) # expand the font core vertically to upper fourth (font core is two fourths)
+    else:
+        ystart = textdata['top'] # set back to original
+        
+    if y2change < -ychangethresh:
+        yend += int(round(h/2.0)) # expand the font core vertically to lower fourth (font core is two fourths)
+    else:
+        yend = textdata['top']+textdata['height'] # set back to original
+
+    # modify the bbox
+    if x1change > xchangethresh or x2change < -xchangethresh or y1change > ychangethresh or y2change < -ychangethresh:
+        # limit to within img
+        ystart,yend = max(0,ystart), min(im_arr.shape[0], yend)
+        xstart,xend = max(0,xstart), min(im_arr.shape[1], xend)
+
+        # update textbox
+        textdata['left'] = xstart
+        textdata['width'] = xend-xstart
+        textdata['top'] = ystart
+        textdata['height'] = yend-ystart
+        textdata['fontheight'] = textdata['height']
+
+    return textdata
+
+
+def simulate_image(n, size=(1000,800), seed=None):
+    # grayscale ocr mask with text-like blobs of ink, and ocr boxes around each
+    # with random padding so that some boxes are much larger than their text
+    random.seed(seed)
+    w,h = size
+    im_arr = np.full((h,w), 255, dtype=np.uint8)
+    texts = []
+    for _ in range(n):
+        fh = random.randint(4,30)
+        length = random.randint(1,12)
+        x,y = random.randint(0,w-1), random.randint(0,h-1)
+        for i in range(length):
+            cx = x + i*fh*2//3
+            im_arr[y:y+fh, cx:cx+fh//2] = random.randint(0,200)
+        pads = [random.choice([0,1,2,fh,fh*3]) for _ in range(4)]
+        left,top = max(0,x-pads[0]), max(0,y-pads[1])
+        right,bottom = min(w,x+length*fh*2//3+pads[2]), min(h,y+fh+pads[3])
+        texts.append({'text':'x'*random.randint(1,12), 'left':left, 'top':top,
+                      'width':max(1,right-left), 'height':max(1,bottom-top), 'fontheight':fh})
+    # noise
+    noise = np.random.RandomState(seed).rand(h,w) < 0.01
+    im_arr[noise] = 0
+    return im_arr, texts
+
+
+def check(im_arr, texts):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # the original warns about means of empty histograms
+        expected = [refine_textbox_loops(im_arr, dict(r)) for r in texts]
+    single = [refine_textbox(im_arr, dict(r)) for r in texts]
+    batched = refine_textboxes(im_arr, [dict(r) for r in texts])
+    changed = sum((r != r2 for r,r2 in zip(texts,expected)))
+    print('{} texts, {} refined'.format(len(texts), changed))
+    assert single == expected
+    assert batched == expected
+
+
+def test_refine_textbox():
+    for n in (0, 1, 10, 100, 1000):
+        check(*simulate_image(n, seed=n))
+    check(*simulate_image(100, size=(400,300), seed=2))
+
+
+if __name__ == '__main__':
+    test_refine_textbox()